@@ -0,0 +1,43 @@
+import time
+from datetime import datetime, timezone
+from typing import Optional, Union
+
+# -----------------------------------------------------------------------------
+# Prazo de validade das mensagens: campo 'deadline' (epoch em ms). Mensagens
+# vencidas são descartadas em cada etapa e contadas por etapa no hash abaixo.
+# -----------------------------------------------------------------------------
+EXPIRED_STATS_KEY = "expired_messages"
+
+def compute_deadline(ttl_seconds: Optional[float] = None, deadline: Union[datetime, str, int, None] = None,
+                     start_ms: Optional[int] = None) -> Optional[int]:
+    """
+    Deadline em epoch ms a partir de um horário absoluto ('deadline': datetime
+    ou texto ISO, UTC se sem fuso, ou epoch ms) ou de um TTL contado desde
+    'start_ms' (padrão: agora). Se ambos forem informados, vale o mais próximo.
+    """
+    candidates = []
+    if isinstance(deadline, str):
+        deadline = datetime.fromisoformat(deadline)
+    if isinstance(deadline, (int, float)):
+        candidates.append(int(deadline))
+    elif deadline is not None:
+        if deadline.tzinfo is None:
+            deadline = deadline.replace(tzinfo=timezone.utc)
+        candidates.append(int(deadline.timestamp() * 1000))
+    if ttl_seconds is not None:
+        start_ms = start_ms if start_ms is not None else int(time.time() * 1000)
+        candidates.append(start_ms + int(ttl_seconds * 1000))
+    return min(candidates) if candidates else None
+
+def is_expired(message: dict, now_ms: Optional[int] = None) -> bool:
+    deadline = message.get("deadline")
+    if deadline is None:
+        return False
+    return (now_ms if now_ms is not None else int(time.time() * 1000)) >= deadline
+
+def count_expired(conn, stage: str):
+    """Incrementa o contador de vencidas da etapa (conexão síncrona)."""
+    conn.hincrby(EXPIRED_STATS_KEY, stage, 1)
+
+async def count_expired_async(conn, stage: str):
+    await conn.hincrby(EXPIRED_STATS_KEY, stage, 1)
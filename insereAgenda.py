@@ -20,7 +20,8 @@ payload = [
             9002,
             "GetBooks&companyid=9001&startdate=2022-08-11&enddate=2022-08-15"
         ],
-        "kwargs": {}
+        # Ações recorrentes iguais são coalescidas enquanto o cliente está offline
+        "kwargs": {"coalesce_key": "GetBooks:9001"}
     }
 ]
 
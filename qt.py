@@ -8,6 +8,9 @@ from rq_scheduler import Scheduler
 from redis import Redis
 from multiprocessing import Process
 
+from redis_topology import RQ_REDIS_URL
+from recurring import MATERIALIZE_INTERVAL, materialize_due_rules
+
 # -----------------------------------------
 # Carrega .env (se existir) para o ambiente
 # -----------------------------------------
@@ -36,8 +39,8 @@ logging.getLogger("rq.scheduler").setLevel(numeric_level)
 logging.getLogger("rq.worker").setLevel(numeric_level)
 logging.getLogger("rq").setLevel(numeric_level)
 
-# Conexão Redis
-REDIS_URL = "redis://redis:6379"
+# Conexão Redis (RQ não suporta Redis Cluster: usa RQ_REDIS_URL, ver redis_topology.py)
+REDIS_URL = RQ_REDIS_URL
 redis_conn = Redis.from_url(REDIS_URL, decode_responses=False)
 
 # Scheduler RQ
@@ -51,6 +54,20 @@ def start_scheduler():
         scheduler.run(burst=False)
         time.sleep(5)
 
+def start_materializer():
+    """Materializa as ocorrências das regras recorrentes que entram na janela de antecedência."""
+    logging.info("🔁 Materializador de regras recorrentes iniciado...")
+    rules_conn = Redis.from_url(REDIS_URL, decode_responses=True)
+    rules_scheduler = Scheduler(connection=rules_conn)
+    while True:
+        try:
+            created = materialize_due_rules(rules_conn, rules_scheduler)
+            if created:
+                logging.info(f"Regras recorrentes: {created} ocorrência(s) materializada(s)")
+        except Exception as e:
+            logging.error(f"Erro no materializador de regras recorrentes: {e}")
+        time.sleep(MATERIALIZE_INTERVAL)
+
 def start_worker():
     """Inicia o RQ Worker e reinicia se falhar."""
     while True:
@@ -73,14 +90,17 @@ def start_worker():
             time.sleep(2)
 
 if __name__ == "__main__":
-    # Cria processos para Worker e Scheduler
+    # Cria processos para Worker, Scheduler e materializador das regras recorrentes
     worker_process = Process(target=start_worker)
     scheduler_process = Process(target=start_scheduler)
+    materializer_process = Process(target=start_materializer)
 
-    # Inicia ambos
+    # Inicia os três
     worker_process.start()
     scheduler_process.start()
+    materializer_process.start()
 
     # Aguarda finalização
     worker_process.join()
     scheduler_process.join()
+    materializer_process.join()
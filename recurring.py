@@ -0,0 +1,251 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import List, Optional
+from zoneinfo import ZoneInfo
+
+from crontab import CronTab
+from redis.exceptions import LockError
+from rq.job import Job
+
+from deadlines import compute_deadline
+from tasks import publish_event
+
+# -----------------------------------------------------------------------------
+# Regras recorrentes: uma regra por cliente e ação (cron ou intervalo, com fuso).
+# Só as ocorrências dentro da janela de antecedência viram jobs do rq-scheduler;
+# memória e custo de varredura dependem do número de regras, não de ocorrências.
+#
+#   recurring_rules                 hash  rule_id -> regra (JSON)
+#   recurring_rules:next            zset  rule_id -> próxima ocorrência ainda não materializada (epoch s)
+#   recurring_rules:jobs:{rule_id}  zset  job_id  -> ocorrência (jobs materializados da regra)
+#   recurring_rules:client:{id}     set   rule_ids do cliente
+# -----------------------------------------------------------------------------
+RULES_KEY = "recurring_rules"
+NEXT_KEY = "recurring_rules:next"
+# Janela de antecedência: precisa ser maior que o intervalo do materializador
+LOOKAHEAD_SECONDS = int(os.getenv("RECURRING_LOOKAHEAD", "900"))
+MATERIALIZE_INTERVAL = int(os.getenv("RECURRING_MATERIALIZE_INTERVAL", "60"))
+# Ocorrências atrasadas mais que isso (materializador parado) são puladas, sem rajada de disparos
+MISFIRE_GRACE = int(os.getenv("RECURRING_MISFIRE_GRACE", "300"))
+# Menor intervalo aceito entre ocorrências (intervalo ou cron) e teto de jobs por
+# regra a cada passada: mantêm os jobs proporcionais ao número de regras
+MIN_INTERVAL_SECONDS = int(os.getenv("RECURRING_MIN_INTERVAL", "60"))
+MAX_OCCURRENCES_PER_PASS = int(os.getenv("RECURRING_MAX_OCCURRENCES_PER_PASS", "20"))
+
+def jobs_key(rule_id: str) -> str:
+    return f"recurring_rules:jobs:{rule_id}"
+
+def client_rules_key(cliente_id: int) -> str:
+    return f"recurring_rules:client:{cliente_id}"
+
+def lock_key(rule_id: str) -> str:
+    return f"recurring_rules:lock:{rule_id}"
+
+def rule_id_for(cliente_id: int, action_params: str) -> str:
+    """Id determinístico: salvar de novo a mesma ação do cliente edita a regra existente."""
+    return f"{cliente_id}-{hashlib.sha1(action_params.encode()).hexdigest()[:12]}"
+
+def occurrence_job_id(rule_id: str, occurrence: int) -> str:
+    """Id do job da ocorrência: materializar de novo sobrescreve o mesmo job em vez de duplicar."""
+    return f"recurring-{rule_id}-{occurrence}"
+
+# -----------------------------------------------------------------------------
+# Cálculo das ocorrências
+# -----------------------------------------------------------------------------
+def validate_rule(rule: dict):
+    """Levanta ValueError se a regra for inválida."""
+    if bool(rule.get("cron")) == bool(rule.get("interval_seconds")):
+        raise ValueError("Informe exatamente um entre 'cron' e 'interval_seconds'")
+    if rule.get("interval_seconds") is not None and rule["interval_seconds"] < MIN_INTERVAL_SECONDS:
+        raise ValueError(f"'interval_seconds' deve ser de pelo menos {MIN_INTERVAL_SECONDS}s")
+    if rule.get("cron"):
+        CronTab(rule["cron"])
+    try:
+        ZoneInfo(rule.get("timezone") or "UTC")
+    except Exception:
+        raise ValueError(f"Fuso horário inválido: {rule.get('timezone')}")
+    if rule.get("cron"):
+        # Cron que nunca dispara (ex: '0 0 30 2 *') levanta ValueError aqui.
+        # Cron com campo de segundos (ex: '*/5 * * * * * *') também respeita o mínimo
+        occurrences = upcoming_occurrences({**rule, "start_at": None}, count=10)
+        gap = min((b - a for a, b in zip(occurrences, occurrences[1:])), default=MIN_INTERVAL_SECONDS)
+        if gap < MIN_INTERVAL_SECONDS:
+            raise ValueError(f"cron dispara a cada {gap}s; o mínimo é {MIN_INTERVAL_SECONDS}s")
+
+def next_occurrence(rule: dict, after: float) -> int:
+    """
+    Primeira ocorrência (epoch s) estritamente depois de 'after'.
+    Levanta ValueError se o cron não tiver mais ocorrências.
+    """
+    start_at = rule.get("start_at")
+    if start_at is not None and after < start_at:
+        if rule.get("interval_seconds"):
+            return int(start_at)
+        # Cron: a primeira ocorrência pode cair exatamente em start_at
+        after = start_at - 1
+    if rule.get("interval_seconds"):
+        interval = rule["interval_seconds"]
+        anchor = rule["anchor"]
+        return int(anchor + (int((after - anchor) // interval) + 1) * interval)
+    # Cron avaliado no fuso da regra (respeita horário de verão)
+    local_now = datetime.fromtimestamp(after, ZoneInfo(rule.get("timezone") or "UTC"))
+    delay = CronTab(rule["cron"]).next(now=local_now, default_utc=False)
+    if delay is None:
+        raise ValueError(f"cron '{rule['cron']}' não tem próxima ocorrência")
+    return int(round(after + delay))
+
+def upcoming_occurrences(rule: dict, count: int = 5, after: Optional[float] = None) -> List[int]:
+    """Até 'count' próximas ocorrências; ValueError se não houver nenhuma."""
+    occurrences = []
+    occurrence = after if after is not None else time.time()
+    for _ in range(count):
+        try:
+            occurrence = next_occurrence(rule, occurrence)
+        except ValueError:
+            # Cron com fim (ex: campo de ano): devolve as que existem
+            if occurrences:
+                break
+            raise
+        occurrences.append(occurrence)
+    return occurrences
+
+# -----------------------------------------------------------------------------
+# Armazenamento das regras
+# -----------------------------------------------------------------------------
+def get_rule(conn, rule_id: str) -> Optional[dict]:
+    raw = conn.hget(RULES_KEY, rule_id)
+    return json.loads(raw) if raw else None
+
+def list_client_rules(conn, cliente_id: int) -> List[dict]:
+    rule_ids = sorted(conn.smembers(client_rules_key(cliente_id)))
+    if not rule_ids:
+        return []
+    return [json.loads(raw) for raw in conn.hmget(RULES_KEY, rule_ids) if raw]
+
+def save_rule(conn, scheduler, rule: dict) -> dict:
+    """
+    Cria ou substitui a regra. A edição vale na hora: os jobs já materializados
+    para o futuro são cancelados e a janela é materializada de novo.
+    """
+    validate_rule(rule)
+    now = time.time()
+    rule = dict(rule)
+    rule["rule_id"] = rule_id_for(rule["cliente_id"], rule["action_params"])
+    rule["timezone"] = rule.get("timezone") or "UTC"
+    rule["anchor"] = rule.get("start_at") or int(now)
+    rule_id = rule["rule_id"]
+
+    with conn.lock(lock_key(rule_id), timeout=30, blocking_timeout=10):
+        cancel_materialized(conn, scheduler, rule_id, after=now)
+        pipe = conn.pipeline()
+        pipe.hset(RULES_KEY, rule_id, json.dumps(rule))
+        pipe.sadd(client_rules_key(rule["cliente_id"]), rule_id)
+        pipe.zadd(NEXT_KEY, {rule_id: next_occurrence(rule, now)})
+        pipe.execute()
+        _materialize(conn, scheduler, rule, now)
+    return rule
+
+def delete_rule(conn, scheduler, rule_id: str) -> bool:
+    with conn.lock(lock_key(rule_id), timeout=30, blocking_timeout=10):
+        rule = get_rule(conn, rule_id)
+        if rule is None:
+            return False
+        cancel_materialized(conn, scheduler, rule_id, after=time.time())
+        pipe = conn.pipeline()
+        pipe.hdel(RULES_KEY, rule_id)
+        pipe.zrem(NEXT_KEY, rule_id)
+        pipe.srem(client_rules_key(rule["cliente_id"]), rule_id)
+        pipe.delete(jobs_key(rule_id))
+        pipe.execute()
+    return True
+
+def materialized_jobs(conn, rule_id: str) -> List[dict]:
+    return [
+        {"job_id": job_id, "occurrence": int(score)}
+        for job_id, score in conn.zrange(jobs_key(rule_id), 0, -1, withscores=True)
+    ]
+
+def cancel_materialized(conn, scheduler, rule_id: str, after: float):
+    """Cancela os jobs da regra com ocorrência ainda por vir."""
+    job_ids = conn.zrangebyscore(jobs_key(rule_id), after, "+inf")
+    for job_id in job_ids:
+        scheduler.cancel(job_id)
+        conn.delete(Job.key_for(job_id))
+    if job_ids:
+        conn.zrem(jobs_key(rule_id), *job_ids)
+
+# -----------------------------------------------------------------------------
+# Materializador
+# -----------------------------------------------------------------------------
+def _materialize(conn, scheduler, rule: dict, now: float) -> int:
+    """Cria os jobs das ocorrências até now + LOOKAHEAD_SECONDS (chamar com o lock da regra)."""
+    rule_id = rule["rule_id"]
+    occurrence = conn.zscore(NEXT_KEY, rule_id)
+    if occurrence is None:
+        return 0
+    occurrence = int(occurrence)
+    if occurrence < now - MISFIRE_GRACE:
+        logging.warning(f"Regra {rule_id}: ocorrências desde {occurrence} perdidas, retomando a partir de agora")
+        occurrence = _next_or_none(rule, now)
+
+    horizon = now + LOOKAHEAD_SECONDS
+    created = 0
+    # O teto só adia: as ocorrências restantes ficam para a próxima passada
+    while occurrence is not None and occurrence <= horizon and created < MAX_OCCURRENCES_PER_PASS:
+        job_id = occurrence_job_id(rule_id, occurrence)
+        kwargs = {"job_id": job_id, "priority": rule.get("priority") or "bulk"}
+        if rule.get("coalesce_key"):
+            kwargs["coalesce_key"] = rule["coalesce_key"]
+        if rule.get("ttl_seconds") is not None:
+            kwargs["deadline"] = compute_deadline(rule["ttl_seconds"], start_ms=occurrence * 1000)
+        scheduler.enqueue_at(
+            datetime.fromtimestamp(occurrence, timezone.utc), publish_event,
+            rule["cliente_id"], rule["action_params"], **kwargs
+        )
+        conn.zadd(jobs_key(rule_id), {job_id: occurrence})
+        occurrence = _next_or_none(rule, occurrence)
+        created += 1
+
+    pipe = conn.pipeline()
+    if occurrence is None:
+        # Cron sem mais ocorrências: a regra fica salva, mas sai da varredura
+        logging.warning(f"Regra {rule_id}: cron sem próximas ocorrências, materialização encerrada")
+        pipe.zrem(NEXT_KEY, rule_id)
+    else:
+        pipe.zadd(NEXT_KEY, {rule_id: occurrence})
+    # Jobs que já dispararam saem do índice da regra
+    pipe.zremrangebyscore(jobs_key(rule_id), "-inf", now - MISFIRE_GRACE)
+    pipe.execute()
+    return created
+
+def _next_or_none(rule: dict, after: float) -> Optional[int]:
+    try:
+        return next_occurrence(rule, after)
+    except ValueError:
+        return None
+
+def materialize_due_rules(conn, scheduler, now: Optional[float] = None) -> int:
+    """
+    Materializa as regras cuja próxima ocorrência entrou na janela. Lê só as
+    regras vencendo (ZRANGEBYSCORE), não todas. Regras em edição são puladas:
+    quem edita já materializa a janela.
+    """
+    now = now if now is not None else time.time()
+    created = 0
+    for rule_id in conn.zrangebyscore(NEXT_KEY, "-inf", now + LOOKAHEAD_SECONDS):
+        try:
+            with conn.lock(lock_key(rule_id), timeout=30, blocking_timeout=0):
+                rule = get_rule(conn, rule_id)
+                if rule is None:
+                    conn.zrem(NEXT_KEY, rule_id)
+                    continue
+                created += _materialize(conn, scheduler, rule, now)
+        except LockError:
+            continue
+        except Exception as e:
+            logging.error(f"Erro ao materializar a regra {rule_id}: {e}")
+    return created
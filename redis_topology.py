@@ -0,0 +1,120 @@
+import os
+import sys
+from typing import List, Tuple
+from dotenv import load_dotenv
+
+import redis
+import redis.asyncio as aredis
+
+# -----------------------------------------------------------------------------
+# Topologia do Redis compartilhada por serverWS, scheduler_api, qt e tasks
+# -----------------------------------------------------------------------------
+BASE_DIR = os.path.dirname(os.path.abspath(sys.executable)) if getattr(sys, 'frozen', False) else os.path.dirname(os.path.abspath(__file__))
+dotenv_path = os.path.join(BASE_DIR, ".env")
+load_dotenv(dotenv_path)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379")
+# REDIS_CLUSTER=1 usa Redis Cluster (REDIS_URL aponta para qualquer nó do cluster)
+REDIS_CLUSTER = os.getenv("REDIS_CLUSTER", "0").lower() in ("1", "true", "yes")
+# RQ e rq-scheduler não suportam Redis Cluster: as filas de jobs usam um nó próprio
+RQ_REDIS_URL = os.getenv("RQ_REDIS_URL", REDIS_URL)
+
+CHANNEL = "canal_eventos"
+# Presença (active_clients) e canal de eventos divididos em N partes, cada uma
+# com hash tag própria para se espalhar pelos slots do cluster. Com 1 parte
+# mantém os nomes originais ('active_clients' e 'canal_eventos').
+PRESENCE_SHARDS = int(os.getenv("PRESENCE_SHARDS", "16" if REDIS_CLUSTER else "1"))
+EVENT_CHANNEL_SHARDS = int(os.getenv("EVENT_CHANNEL_SHARDS", "16" if REDIS_CLUSTER else "1"))
+
+# -----------------------------------------------------------------------------
+# Layout das chaves
+# -----------------------------------------------------------------------------
+def client_tag(cliente_id: int) -> str:
+    """
+    Parte da chave que identifica o cliente. Em cluster vira hash tag '{id}',
+    para que todas as chaves do cliente (pendentes, coalescência, estatísticas)
+    fiquem no mesmo slot e possam ser usadas juntas nos scripts Lua.
+    """
+    return f"{{{cliente_id}}}" if REDIS_CLUSTER else str(cliente_id)
+
+def presence_shard(cliente_id: int) -> int:
+    return cliente_id % PRESENCE_SHARDS
+
+def presence_key(shard: int) -> str:
+    if PRESENCE_SHARDS == 1:
+        return "active_clients"
+    return f"active_clients:{{{shard}}}"
+
+def presence_keys() -> List[str]:
+    return [presence_key(shard) for shard in range(PRESENCE_SHARDS)]
+
+def group_key(group: str) -> str:
+    """Clientes conectados de um grupo (informado no handshake pelo agente)."""
+    return f"group_clients:{group}"
+
+def event_channel(cliente_id: int) -> str:
+    """Canal de eventos em que as mensagens do cliente são publicadas."""
+    if EVENT_CHANNEL_SHARDS == 1:
+        return CHANNEL
+    return f"{CHANNEL}:{{{cliente_id % EVENT_CHANNEL_SHARDS}}}"
+
+def event_channels() -> List[str]:
+    if EVENT_CHANNEL_SHARDS == 1:
+        return [CHANNEL]
+    return [f"{CHANNEL}:{{{shard}}}" for shard in range(EVENT_CHANNEL_SHARDS)]
+
+# -----------------------------------------------------------------------------
+# Conexões
+# -----------------------------------------------------------------------------
+def get_redis(decode_responses: bool = True):
+    """Conexão síncrona (scheduler_api, tasks)."""
+    if REDIS_CLUSTER:
+        return redis.RedisCluster.from_url(REDIS_URL, decode_responses=decode_responses)
+    return redis.Redis.from_url(REDIS_URL, decode_responses=decode_responses)
+
+def get_async_redis(decode_responses: bool = True):
+    """Conexão assíncrona (serverWS)."""
+    if REDIS_CLUSTER:
+        return aredis.RedisCluster.from_url(REDIS_URL, decode_responses=decode_responses)
+    return aredis.Redis.from_url(REDIS_URL, decode_responses=decode_responses)
+
+def publish_event(conn, cliente_id: int, payload: str) -> int:
+    """
+    Publica o evento no canal do cliente. Em cluster usa pub/sub particionado
+    (SPUBLISH), entregue só pelo nó dono do slot do canal, em vez de PUBLISH,
+    que é repassado a todos os nós.
+    """
+    if REDIS_CLUSTER:
+        return conn.spublish(event_channel(cliente_id), payload)
+    return conn.publish(event_channel(cliente_id), payload)
+
+async def subscribe_events(conn):
+    """Assina todos os canais de eventos; retorna (pubsub, função que lê a próxima mensagem)."""
+    if REDIS_CLUSTER and not hasattr(conn, "pubsub"):
+        # redis.asyncio.RedisCluster só tem pub/sub (ClusterPubSub) a partir do redis-py 8.0
+        raise RuntimeError("REDIS_CLUSTER=1 requer redis-py >= 8.0 (pub/sub no cliente assíncrono de cluster)")
+    pubsub = conn.pubsub()
+    if REDIS_CLUSTER:
+        await pubsub.ssubscribe(*event_channels())
+        return pubsub, pubsub.get_sharded_message
+    await pubsub.subscribe(*event_channels())
+    return pubsub, pubsub.get_message
+
+async def scan_page(conn, cursor: str, match: str, count: int) -> Tuple[str, list]:
+    """
+    Uma página de SCAN. Em cluster percorre os nós primários em sequência e o
+    cursor tem a forma '<índice do nó>-<cursor no nó>'. Cursor '0' marca o fim.
+    """
+    if not REDIS_CLUSTER:
+        next_cursor, keys = await conn.scan(cursor=int(cursor), match=match, count=count)
+        return str(next_cursor), keys
+
+    nodes = sorted(conn.get_primaries(), key=lambda node: node.name)
+    node_index, node_cursor = (int(part) for part in cursor.split("-")) if "-" in cursor else (0, int(cursor))
+    node = nodes[node_index]
+    cursors, keys = await conn.scan(cursor=node_cursor, match=match, count=count, target_nodes=node)
+    if cursors[node.name] != 0:
+        return f"{node_index}-{cursors[node.name]}", keys
+    if node_index + 1 < len(nodes):
+        return f"{node_index + 1}-0", keys
+    return "0", keys
@@ -1,7 +1,13 @@
 #!/bin/bash
 
-echo "Reiniciando server.py com 4 workers..."
-pkill -f "uvicorn serverWS:app"
-sleep 2
-uvicorn serverWS:app --workers 4 --host 0.0.0.0 --port 9000 --log-level error &
+# Reinício gradual: com SIGHUP o processo principal do uvicorn reinicia um worker
+# por vez; cada worker drena suas conexões (ver graceful_shutdown em serverWS.py)
+MASTER_PID=$(pgrep -o -f "uvicorn serverWS:app")
+if [ -n "$MASTER_PID" ]; then
+    echo "Reiniciando workers do server.py um a um (PID $MASTER_PID)..."
+    kill -HUP "$MASTER_PID"
+else
+    echo "Iniciando server.py com 4 workers..."
+    uvicorn serverWS:app --workers 4 --host 0.0.0.0 --port 9000 --log-level error --timeout-graceful-shutdown 30 &
+fi
 echo "server.py reiniciado com sucesso!"
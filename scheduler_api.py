@@ -1,17 +1,24 @@
 import os
 import logging
 from dotenv import load_dotenv
-from datetime import datetime
-from typing import List
+from datetime import datetime, timezone
+from typing import List, Literal, Optional
 import importlib
+import inspect
 import sys
 import json
 from fastapi import FastAPI, HTTPException, Depends
 from pydantic import BaseModel, Field
 from redis import Redis
+from redis.exceptions import LockError
 from rq_scheduler import Scheduler as RQScheduler
 from rq.job import Job
 
+from redis_topology import CHANNEL, RQ_REDIS_URL, get_redis, publish_event
+from deadlines import compute_deadline
+from tracing import new_trace_id, now_ms, record_hop
+import recurring
+
 # ---------------------------------------------------------------
 # Carregamento e configuração de variáveis de ambiente (dotenv)
 # ---------------------------------------------------------------
@@ -39,8 +46,10 @@ logging.info(f"LOG_LEVEL={LOG_LEVEL}")
 # ---------------------------------------------------------------
 # Conexão com Redis e criação do RQ Scheduler
 # ---------------------------------------------------------------
-REDIS_URL = "redis://redis:6379"
-sync_redis_conn = Redis.from_url(REDIS_URL, decode_responses=True)
+# RQ não suporta Redis Cluster: jobs ficam em RQ_REDIS_URL; eventos seguem
+# a topologia configurada (REDIS_URL / REDIS_CLUSTER, ver redis_topology.py)
+sync_redis_conn = Redis.from_url(RQ_REDIS_URL, decode_responses=True)
+events_redis_conn = get_redis(decode_responses=True)
 rq_scheduler = RQScheduler(connection=sync_redis_conn)
 
 # ---------------------------------------------------------------
@@ -56,6 +65,8 @@ class ScheduleTask(BaseModel):
     schedule_time: datetime = Field(..., description="Data e hora (UTC) para executar")
     args: List = Field(default_factory=list)
     kwargs: dict = Field(default_factory=dict)
+    ttl_seconds: Optional[float] = Field(None, description="Validade da ação, contada a partir de schedule_time")
+    deadline: Optional[datetime] = Field(None, description="Data e hora (UTC) após a qual a ação é descartada")
 
 # ---------------------------------------------------------------
 # Rota: POST /schedule
@@ -68,8 +79,26 @@ async def schedule_tasks(tasks: List[ScheduleTask], username: str = Depends(lamb
             module_name, function_name = task.function.rsplit('.', 1)
             mod = importlib.import_module(module_name)
             func = getattr(mod, function_name)
-            job = rq_scheduler.enqueue_at(task.schedule_time, func, *task.args, **task.kwargs)
-            jobs_info.append({"job_id": job.get_id(), "schedule_time": task.schedule_time})
+            kwargs = dict(task.kwargs)
+            trace_id = None
+            signature = inspect.signature(func)
+            schedule_time = task.schedule_time
+            if schedule_time.tzinfo is None:
+                schedule_time = schedule_time.replace(tzinfo=timezone.utc)
+            due = int(schedule_time.timestamp() * 1000)
+            if task.ttl_seconds is not None or task.deadline is not None:
+                if "deadline" not in signature.parameters:
+                    raise ValueError(f"{task.function} não aceita deadline")
+                # Prazo absoluto: um disparo atrasado do scheduler também conta contra a validade
+                kwargs["deadline"] = compute_deadline(task.ttl_seconds, task.deadline, start_ms=due)
+            if "trace_id" in signature.parameters and "cliente_id" in signature.parameters:
+                # Funções que aceitam trace_id (ex: tasks.publish_event) são rastreadas desde o agendamento
+                cliente_id = signature.bind_partial(*task.args, **kwargs).arguments.get("cliente_id")
+                trace_id = kwargs.setdefault("trace_id", new_trace_id())
+                record_hop(events_redis_conn, cliente_id, trace_id, "accepted")
+                record_hop(events_redis_conn, cliente_id, trace_id, "due", due)
+            job = rq_scheduler.enqueue_at(task.schedule_time, func, *task.args, **kwargs)
+            jobs_info.append({"job_id": job.get_id(), "schedule_time": task.schedule_time, "trace_id": trace_id})
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Erro ao agendar tarefa: {str(e)}")
     return {"message": "Tarefas agendadas com sucesso", "jobs": jobs_info}
@@ -111,18 +140,99 @@ class NonScheduledMessage(BaseModel):
     channel: str = Field(..., description="Nome do canal Redis para publicação")
     cliente_id: int = Field(..., description="ID do cliente que receberá a mensagem")
     action_params: str = Field(..., description="Parâmetros da ação que será executada")
+    coalesce_key: Optional[str] = Field(None, description="Chave de coalescência: pendente mais nova substitui a anterior com a mesma chave")
+    priority: Literal["interactive", "bulk"] = Field("interactive", description="Fila de prioridade: 'interactive' é servida antes de 'bulk'")
+    ttl_seconds: Optional[float] = Field(None, description="Validade da ação em segundos; vencida, é descartada")
+    deadline: Optional[datetime] = Field(None, description="Data e hora (UTC) após a qual a ação é descartada")
 
 @app.post("/message")
 async def create_message(msg: NonScheduledMessage, username: str = Depends(lambda: "admin")):
     """
     Recebe uma mensagem para ser publicada diretamente em um canal Redis no mesmo formato das mensagens agendadas.
     """
+    accepted = now_ms()
     event = {
         "cliente_id": msg.cliente_id,
-        "action_params": msg.action_params
+        "action_params": msg.action_params,
+        "priority": msg.priority
     }
+    if msg.coalesce_key:
+        event["coalesce_key"] = msg.coalesce_key
+    trace_id = new_trace_id()
+    if trace_id:
+        event["trace_id"] = trace_id
+    deadline = compute_deadline(msg.ttl_seconds, msg.deadline, start_ms=accepted)
+    if deadline is not None:
+        event["deadline"] = deadline
 
     message = json.dumps(event)  # Converte para JSON antes de publicar
-    sync_redis_conn.publish(msg.channel, message)
+    if msg.channel == CHANNEL:
+        # Canal de eventos padrão: roteia para a partição do cliente
+        publish_event(events_redis_conn, msg.cliente_id, message)
+    else:
+        events_redis_conn.publish(msg.channel, message)
+    record_hop(events_redis_conn, msg.cliente_id, trace_id, "accepted", accepted)
+    record_hop(events_redis_conn, msg.cliente_id, trace_id, "published")
     
     return {"status": "ok", "channel": msg.channel, "content": event}
+
+# ---------------------------------------------------------------
+# Regras recorrentes (cron ou intervalo), uma por cliente e ação.
+# O materializador (qt.py) cria só os jobs da janela de antecedência.
+# ---------------------------------------------------------------
+class RecurringRule(BaseModel):
+    cliente_id: int = Field(..., description="ID do cliente que receberá a ação")
+    action_params: str = Field(..., description="Parâmetros da ação; a mesma ação do cliente edita a regra existente")
+    cron: Optional[str] = Field(None, description="Expressão cron, ex: '0 6,12,18 * * *'")
+    interval_seconds: Optional[int] = Field(None, description="Intervalo fixo entre ocorrências, em segundos")
+    timezone: str = Field("UTC", description="Fuso horário em que o cron é avaliado, ex: 'America/Sao_Paulo'")
+    start_at: Optional[datetime] = Field(None, description="Início da regra (UTC se sem fuso); âncora do intervalo")
+    coalesce_key: Optional[str] = Field(None, description="Chave de coalescência das ocorrências")
+    priority: Literal["interactive", "bulk"] = Field("bulk", description="Fila de prioridade das ocorrências")
+    ttl_seconds: Optional[float] = Field(None, description="Validade de cada ocorrência, contada do horário previsto")
+
+def _rule_view(rule: dict) -> dict:
+    return {
+        **rule,
+        "next_occurrences": [
+            datetime.fromtimestamp(ts, timezone.utc).isoformat()
+            for ts in recurring.upcoming_occurrences(rule)
+        ],
+    }
+
+@app.put("/recurring")
+async def save_recurring_rule(rule: RecurringRule, username: str = Depends(lambda: "admin")):
+    data = rule.dict()
+    if rule.start_at is not None:
+        start_at = rule.start_at if rule.start_at.tzinfo else rule.start_at.replace(tzinfo=timezone.utc)
+        data["start_at"] = int(start_at.timestamp())
+    try:
+        saved = recurring.save_rule(sync_redis_conn, rq_scheduler, data)
+    except LockError:
+        # LockError herda de ValueError: precisa vir antes
+        raise HTTPException(status_code=409, detail="Regra em edição por outra requisição; tente novamente")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Regra inválida: {str(e)}")
+    return {"message": "Regra salva com sucesso", "rule": _rule_view(saved)}
+
+@app.get("/recurring/client/{cliente_id}")
+async def list_recurring_rules(cliente_id: int, username: str = Depends(lambda: "admin")):
+    rules = recurring.list_client_rules(sync_redis_conn, cliente_id)
+    return {"cliente_id": cliente_id, "rules": [_rule_view(rule) for rule in rules]}
+
+@app.get("/recurring/{rule_id}")
+async def get_recurring_rule(rule_id: str, username: str = Depends(lambda: "admin")):
+    rule = recurring.get_rule(sync_redis_conn, rule_id)
+    if rule is None:
+        raise HTTPException(status_code=404, detail="Regra não encontrada")
+    return {"rule": _rule_view(rule), "materialized_jobs": recurring.materialized_jobs(sync_redis_conn, rule_id)}
+
+@app.delete("/recurring/{rule_id}")
+async def remove_recurring_rule(rule_id: str, username: str = Depends(lambda: "admin")):
+    try:
+        removed = recurring.delete_rule(sync_redis_conn, rq_scheduler, rule_id)
+    except LockError:
+        raise HTTPException(status_code=409, detail="Regra em edição por outra requisição; tente novamente")
+    if not removed:
+        raise HTTPException(status_code=404, detail="Regra não encontrada")
+    return {"message": "Regra removida com sucesso", "rule_id": rule_id}
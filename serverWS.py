@@ -1,16 +1,36 @@
 import asyncio
+import base64
+import hashlib
 import json
 import logging
 import os
+import random
+import signal
 import sys
+import threading
+import time
 import uuid
-from typing import Dict
+import zlib
+from typing import Dict, List, Optional, Set
 from dotenv import load_dotenv
 
-import redis.asyncio as redis
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from starlette.websockets import WebSocketState
 
+try:
+    import msgpack
+except ImportError:  # msgpack é opcional: sem ele as pendentes usam JSON compacto
+    msgpack = None
+
+from redis_topology import (
+    client_tag, event_channels, get_async_redis, group_key, presence_key,
+    presence_keys, presence_shard, scan_page, subscribe_events
+)
+from deadlines import EXPIRED_STATS_KEY, count_expired_async, is_expired
+from tracing import (
+    client_traces_key, hop_breakdown, now_ms, record_hop_async, slowest_hop_stats, trace_key
+)
+
 # -----------------------------------------------------------------------------
 # Configuração de logging
 # -----------------------------------------------------------------------------
@@ -34,11 +54,91 @@ logging.basicConfig(
 MY_WORKER_ID = os.getenv("WORKER_ID", f"worker-{uuid.uuid4().hex[:8]}")
 
 # -----------------------------------------------------------------------------
-# Configuração do Redis
+# Configuração do Redis (REDIS_URL / REDIS_CLUSTER, ver redis_topology.py)
 # -----------------------------------------------------------------------------
-REDIS_URL = "redis://redis:6379"
-CHANNEL = "canal_eventos"
-redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+redis_client = get_async_redis(decode_responses=True)
+# Conexão binária para as listas de pendentes (mensagens codificadas/comprimidas)
+pending_redis = get_async_redis(decode_responses=False)
+
+# -----------------------------------------------------------------------------
+# Presença: 'active_clients' dividido em PRESENCE_SHARDS conjuntos
+# -----------------------------------------------------------------------------
+# Contadores por worker (hash 'workers_presence'), atualizados periodicamente;
+# entradas sem atualização há mais de WORKER_STALE_SECONDS são descartadas
+WORKERS_PRESENCE_KEY = "workers_presence"
+WORKER_STALE_SECONDS = int(os.getenv("WORKER_STALE_SECONDS", "60"))
+# Validade (s) do snapshot do inventário servido a dashboards
+INVENTORY_CACHE_TTL = float(os.getenv("INVENTORY_CACHE_TTL", "5"))
+
+def _by_presence_key(cliente_ids: List[int]) -> Dict[str, List[int]]:
+    keys: Dict[str, List[int]] = {}
+    for cliente_id in cliente_ids:
+        keys.setdefault(presence_key(presence_shard(cliente_id)), []).append(cliente_id)
+    return keys
+
+async def presence_add(*cliente_ids: int):
+    for key, ids in _by_presence_key(list(cliente_ids)).items():
+        await redis_client.sadd(key, *ids)
+
+async def presence_remove(*cliente_ids: int):
+    for key, ids in _by_presence_key(list(cliente_ids)).items():
+        await redis_client.srem(key, *ids)
+
+async def presence_contains(cliente_id: int) -> bool:
+    return bool(await redis_client.sismember(presence_key(presence_shard(cliente_id)), cliente_id))
+
+async def presence_total() -> int:
+    """Total de clientes conectados (SCARD em cada parte, O(1) cada)."""
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for key in presence_keys():
+            pipe.scard(key)
+        return sum(await pipe.execute())
+
+async def presence_page(cursor: str, count: int, group: Optional[str] = None):
+    """
+    Uma página do inventário via SSCAN, percorrendo as partes de 'active_clients'
+    (ou o conjunto do grupo). Cursor '<parte>-<cursor>'; '0' marca o fim.
+    """
+    keys = [group_key(group)] if group else presence_keys()
+    key_index, key_cursor = (int(part) for part in cursor.split("-")) if "-" in cursor else (0, int(cursor))
+    next_cursor, members = await redis_client.sscan(keys[key_index], cursor=key_cursor, count=count)
+    if next_cursor != 0:
+        return f"{key_index}-{next_cursor}", members
+    if key_index + 1 < len(keys):
+        return f"{key_index + 1}-0", members
+    return "0", members
+
+async def report_worker_presence(clients: int, sockets: int):
+    await redis_client.hset(
+        WORKERS_PRESENCE_KEY, MY_WORKER_ID,
+        json.dumps({"clients": clients, "sockets": sockets, "ts": int(time.time())})
+    )
+
+async def workers_presence() -> Dict[str, dict]:
+    """Contadores por worker; remove os de workers que pararam de reportar."""
+    now = int(time.time())
+    workers, stale = {}, []
+    for worker_id, raw in (await redis_client.hgetall(WORKERS_PRESENCE_KEY)).items():
+        info = json.loads(raw)
+        if now - info["ts"] > WORKER_STALE_SECONDS:
+            stale.append(worker_id)
+        else:
+            workers[worker_id] = info
+    if stale:
+        await redis_client.hdel(WORKERS_PRESENCE_KEY, *stale)
+    return workers
+
+# -----------------------------------------------------------------------------
+# Respostas reenviadas pelos clientes em chunks (frames 'response_chunk')
+# -----------------------------------------------------------------------------
+RESPONSES_DIR = os.getenv("RESPONSES_DIR", os.path.join(BASE_DIR, "data", "respostas"))
+# Tamanho máximo (bytes) de uma resposta reenviada; acima disso ela é descartada. 0 desativa
+RESPONSE_MAX_BYTES = int(os.getenv("RESPONSE_MAX_BYTES", str(100 * 1024 * 1024)))
+# Retenção em RESPONSES_DIR: apaga arquivos mais velhos que RESPONSES_MAX_AGE (s) e,
+# se o total passar de RESPONSES_MAX_TOTAL_BYTES, os mais antigos primeiro. 0 desativa cada limite
+RESPONSES_MAX_AGE = int(os.getenv("RESPONSES_MAX_AGE", str(7 * 86400)))
+RESPONSES_MAX_TOTAL_BYTES = int(os.getenv("RESPONSES_MAX_TOTAL_BYTES", str(10 * 1024 * 1024 * 1024)))
+RESPONSES_PRUNE_INTERVAL = int(os.getenv("RESPONSES_PRUNE_INTERVAL", "600"))
 
 # -----------------------------------------------------------------------------
 # Usuário e Senha válidos para autenticação
@@ -47,6 +147,9 @@ VALID_USERS = {
     "user": "user123"
 }
 
+# Quantidade máxima de cliente_id que um agente pode registrar numa única conexão
+MAX_CLIENTS_PER_CONNECTION = int(os.getenv("MAX_CLIENTS_PER_CONNECTION", "1000"))
+
 def authenticate(username: str, password: str) -> bool:
     """Valida as credenciais do usuário."""
     return VALID_USERS.get(username) == password
@@ -54,35 +157,599 @@ def authenticate(username: str, password: str) -> bool:
 # -----------------------------------------------------------------------------
 # Armazena mensagem pendente no Redis
 # -----------------------------------------------------------------------------
-async def store_pending_message(cliente_id: int, message: dict):
+PENDING_TTL = 86400  # 24 horas, contadas a partir da primeira pendente
+# Limite de pendentes por cliente e o que fazer ao atingi-lo:
+# "drop_oldest" descarta a mais antiga, "reject" recusa a nova (ambos contabilizados)
+PENDING_MAX_PER_CLIENT = int(os.getenv("PENDING_MAX_PER_CLIENT", "1000"))
+PENDING_OVERFLOW_POLICY = os.getenv("PENDING_OVERFLOW_POLICY", "drop_oldest").lower()
+# Pendentes codificadas acima deste tamanho (bytes) são comprimidas; 0 desativa
+PENDING_COMPRESS_MIN = int(os.getenv("PENDING_COMPRESS_MIN", "512"))
+# Janela em que uma ação com 'coalesce_key' já enviada é considerada em andamento
+INFLIGHT_DEDUP_TTL = int(os.getenv("INFLIGHT_DEDUP_TTL", "60"))
+
+# Filas de prioridade, da mais para a menos prioritária. Mensagens sem 'priority'
+# (ou com valor desconhecido) vão para "bulk". A fila bulk mantém o nome histórico
+# 'pending_messages:{cliente_id}'; as demais usam 'pending_messages:{cliente_id}:{fila}'.
+PRIORITY_LANES = ("interactive", "bulk")
+DEFAULT_LANE = "bulk"
+# Proteção contra inanição: após N envios interativos seguidos, serve um bulk
+LANE_BULK_EVERY = int(os.getenv("LANE_BULK_EVERY", "8"))
+# Tamanho de cada fila de saída em memória por conexão; o excedente vai para as pendentes
+OUTBOUND_QUEUE_SIZE = int(os.getenv("OUTBOUND_QUEUE_SIZE", "100"))
+
+# Desligamento: tempo máximo para esvaziar as filas de saída e janela (s) de
+# atraso aleatório enviada aos clientes no frame 'reconnect'
+SHUTDOWN_FLUSH_TIMEOUT = float(os.getenv("SHUTDOWN_FLUSH_TIMEOUT", "10"))
+RECONNECT_SPREAD = float(os.getenv("RECONNECT_SPREAD", "30"))
+# Tempo máximo para avisar e fechar cada socket, e para a drenagem inteira antes
+# de repassar o sinal ao uvicorn (por padrão, a soma das etapas com folga)
+SHUTDOWN_CLOSE_TIMEOUT = float(os.getenv("SHUTDOWN_CLOSE_TIMEOUT", "2"))
+SHUTDOWN_TOTAL_TIMEOUT = float(os.getenv(
+    "SHUTDOWN_TOTAL_TIMEOUT", str(2 * SHUTDOWN_FLUSH_TIMEOUT + SHUTDOWN_CLOSE_TIMEOUT + 5)
+))
+
+def message_lane(message: dict) -> str:
+    """Fila de prioridade da mensagem."""
+    lane = message.get("priority")
+    return lane if lane in PRIORITY_LANES else DEFAULT_LANE
+
+def pending_key(cliente_id: int, lane: str = DEFAULT_LANE) -> str:
+    if lane == DEFAULT_LANE:
+        return f"pending_messages:{client_tag(cliente_id)}"
+    return f"pending_messages:{client_tag(cliente_id)}:{lane}"
+
+class LanePicker:
+    """
+    Escolhe de qual fila servir: sempre a mais prioritária com itens, exceto
+    quando já serviu LANE_BULK_EVERY seguidas dela e há itens nas demais.
+    """
+    def __init__(self):
+        self.streak = 0
+
+    def pick(self, available: List[str]) -> str:
+        ordered = [lane for lane in PRIORITY_LANES if lane in available]
+        if len(ordered) > 1 and self.streak >= LANE_BULK_EVERY:
+            self.streak = 0
+            return ordered[1]
+        self.streak = self.streak + 1 if ordered[0] == PRIORITY_LANES[0] else 0
+        return ordered[0]
+
+# Mensagens com 'coalesce_key' ficam no hash 'pending_coalesce:{cliente_id}';
+# a lista guarda só uma referência 'ck:<chave>'. Uma mensagem nova com a mesma
+# chave substitui o corpo da anterior em vez de ser anexada à lista; se a
+# referência não estiver mais na lista (ex: a lista expirou antes do hash), o
+# corpo é anexado de novo para não ficar órfão.
+# O limite vale para a soma das filas de prioridade do cliente (KEYS[4..], da
+# menos para a mais prioritária); "drop_oldest" descarta a mais antiga da fila
+# menos prioritária que tiver itens.
+# Retorno: 0 = substituída, 1 = anexada, 2 = anexada descartando a mais antiga, -1 = recusada.
+# O TTL da lista só é definido quando a chave é criada, para que novas mensagens
+# não o renovem. O hash (compartilhado pelas filas de prioridade) expira junto
+# com a lista mais duradoura que o referencia, nunca antes dela.
+STORE_PENDING_LUA = """
+local ck = ARGV[2]
+local ref = 'ck:' .. ck
+if ck ~= '' and redis.call('HEXISTS', KEYS[2], ck) == 1 then
+    if redis.call('LPOS', KEYS[1], ref) then
+        redis.call('HSET', KEYS[2], ck, ARGV[1])
+        return 0
+    end
+    redis.call('HDEL', KEYS[2], ck)
+end
+local result = 1
+local max = tonumber(ARGV[4])
+local total = 0
+for i = 4, #KEYS do
+    total = total + redis.call('LLEN', KEYS[i])
+end
+if max > 0 and total >= max then
+    if ARGV[5] == 'reject' then
+        redis.call('HINCRBY', KEYS[3], 'rejected', 1)
+        redis.call('EXPIRE', KEYS[3], ARGV[3])
+        return -1
+    end
+    local oldest
+    for i = 4, #KEYS do
+        oldest = redis.call('LPOP', KEYS[i])
+        if oldest then
+            break
+        end
+    end
+    if oldest and string.sub(oldest, 1, 3) == 'ck:' then
+        redis.call('HDEL', KEYS[2], string.sub(oldest, 4))
+    end
+    redis.call('HINCRBY', KEYS[3], 'dropped', 1)
+    redis.call('EXPIRE', KEYS[3], ARGV[3])
+    result = 2
+end
+if ck ~= '' then
+    redis.call('HSET', KEYS[2], ck, ARGV[1])
+    redis.call('RPUSH', KEYS[1], ref)
+else
+    redis.call('RPUSH', KEYS[1], ARGV[1])
+end
+if redis.call('TTL', KEYS[1]) < 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+if ck ~= '' then
+    local list_pttl = redis.call('PTTL', KEYS[1])
+    if redis.call('PTTL', KEYS[2]) < list_pttl then
+        redis.call('PEXPIRE', KEYS[2], list_pttl)
+    end
+end
+return result
+"""
+
+# Retira a próxima pendente; referências 'ck:' são resolvidas no hash.
+# Retorna '' se o corpo coalescido não existir mais (ex: hash expirado).
+POP_PENDING_LUA = """
+local entry = redis.call('LPOP', KEYS[1])
+if not entry then
+    return false
+end
+if string.sub(entry, 1, 3) == 'ck:' then
+    local ck = string.sub(entry, 4)
+    local body = redis.call('HGET', KEYS[2], ck)
+    redis.call('HDEL', KEYS[2], ck)
+    return body or ''
+end
+return entry
+"""
+
+store_pending_script = pending_redis.register_script(STORE_PENDING_LUA)
+pop_pending_script = pending_redis.register_script(POP_PENDING_LUA)
+
+def encode_pending(message: dict) -> bytes:
+    """
+    Codifica a mensagem para a lista de pendentes: prefixo 'm' (msgpack) ou
+    'j' (JSON compacto); acima de PENDING_COMPRESS_MIN bytes o resultado é
+    comprimido com zlib e recebe o prefixo 'z'.
+    """
+    if msgpack is not None:
+        raw = b"m" + msgpack.packb(message, use_bin_type=True)
+    else:
+        raw = b"j" + json.dumps(message, separators=(",", ":")).encode("utf-8")
+    if PENDING_COMPRESS_MIN and len(raw) > PENDING_COMPRESS_MIN:
+        return b"z" + zlib.compress(raw)
+    return raw
+
+def decode_pending(raw: bytes) -> dict:
+    """Decodifica uma pendente gravada por encode_pending (ou JSON puro, formato antigo)."""
+    if raw[:1] == b"z":
+        raw = zlib.decompress(raw[1:])
+    if raw[:1] == b"m":
+        if msgpack is None:
+            raise ValueError("Pendente em msgpack, mas o módulo msgpack não está instalado.")
+        return msgpack.unpackb(raw[1:], raw=False)
+    if raw[:1] == b"j":
+        raw = raw[1:]
+    return json.loads(raw)
+
+def message_digest(message: dict) -> str:
+    """Hash estável do conteúdo da mensagem (usado para deduplicar entre workers)."""
+    return hashlib.sha1(json.dumps(message, sort_keys=True).encode("utf-8")).hexdigest()
+
+async def store_pending_message(cliente_id: int, message: dict) -> int:
     """
     Insere a mensagem na lista 'pending_messages:{cliente_id}' e
-    define um TTL (ex: 24h).
+    define um TTL (ex: 24h). Se a mensagem tiver 'coalesce_key', substitui
+    a pendente anterior com a mesma chave. Respeita PENDING_MAX_PER_CLIENT
+    (somando as filas de prioridade) conforme PENDING_OVERFLOW_POLICY;
+    retorna o código do script de armazenamento.
     """
-    key = f"pending_messages:{cliente_id}"
-    await redis_client.rpush(key, json.dumps(message))
-    await redis_client.expire(key, 86400)  # 24 horas
-    logging.info(f"[REDIS] Mensagem armazenada para cliente {cliente_id}: {message}")
+    key = pending_key(cliente_id, message_lane(message))
+    coalesce_key = f"pending_coalesce:{client_tag(cliente_id)}"
+    stats_key = f"pending_stats:{client_tag(cliente_id)}"
+    lane_keys = [pending_key(cliente_id, lane) for lane in reversed(PRIORITY_LANES)]
+    result = await store_pending_script(
+        keys=[key, coalesce_key, stats_key, *lane_keys],
+        args=[
+            encode_pending(message), message.get("coalesce_key") or "", PENDING_TTL,
+            PENDING_MAX_PER_CLIENT, PENDING_OVERFLOW_POLICY
+        ]
+    )
+    if result == -1:
+        logging.error(f"[REDIS] Fila de pendentes do cliente {cliente_id} cheia ({PENDING_MAX_PER_CLIENT}). Mensagem recusada: {message}")
+    elif result == 2:
+        logging.warning(f"[REDIS] Fila de pendentes do cliente {cliente_id} cheia ({PENDING_MAX_PER_CLIENT}). Pendente mais antiga descartada.")
+    else:
+        logging.info(f"[REDIS] Mensagem armazenada para cliente {cliente_id}: {message}")
+    if result != -1:
+        await record_hop_async(redis_client, cliente_id, message.get("trace_id"), "pending_stored")
+    return result
+
+async def pop_pending_message(cliente_id: int, lane: str = DEFAULT_LANE) -> Optional[bytes]:
+    """Retira a próxima mensagem pendente da fila do cliente, codificada (None quando a fila acabou)."""
+    key = pending_key(cliente_id, lane)
+    coalesce_key = f"pending_coalesce:{client_tag(cliente_id)}"
+    return await pop_pending_script(keys=[key, coalesce_key])
+
+async def pending_memory_usage(cliente_id: int) -> dict:
+    """Resumo de ocupação das pendentes do cliente: quantidade por fila, bytes no Redis e descartes."""
+    coalesce_key = f"pending_coalesce:{client_tag(cliente_id)}"
+    stats_key = f"pending_stats:{client_tag(cliente_id)}"
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for lane in PRIORITY_LANES:
+            pipe.llen(pending_key(cliente_id, lane))
+            pipe.memory_usage(pending_key(cliente_id, lane))
+        pipe.memory_usage(coalesce_key)
+        pipe.ttl(pending_key(cliente_id))
+        pipe.hgetall(stats_key)
+        results = await pipe.execute()
+    lanes = {
+        lane: results[2 * i] for i, lane in enumerate(PRIORITY_LANES)
+    }
+    lane_bytes = sum(results[2 * i + 1] or 0 for i in range(len(PRIORITY_LANES)))
+    coalesce_bytes, ttl, stats = results[-3:]
+    return {
+        "cliente_id": cliente_id,
+        "pending": sum(lanes.values()),
+        "lanes": lanes,
+        "bytes": lane_bytes + (coalesce_bytes or 0),
+        "ttl": ttl,
+        "dropped": int(stats.get("dropped", 0)),
+        "rejected": int(stats.get("rejected", 0))
+    }
 
 # -----------------------------------------------------------------------------
 # Função para armazenar mensagem se cliente estiver OFFLINE
 # -----------------------------------------------------------------------------
-async def store_message_if_offline(cliente_id: int, message: dict):
+async def store_message_if_offline(cliente_id: int, message: dict, received_at: Optional[int] = None):
     """
-    Usa um lock simples (setnx) para evitar duplicações.
+    Usa um lock simples (set nx) para evitar duplicações.
     Assim, só um worker insere a mensagem pendente se o cliente estiver offline.
+    O lock é por conteúdo, para não descartar mensagens diferentes recebidas em sequência.
+    Vinda do redis_listener ('received_at' informado), só o worker que ganhou o lock
+    grava a etapa 'listener' e descarta/contabiliza a mensagem se ela já venceu.
     """
-    lock_key = f"pending_lock:{cliente_id}"
-    was_set = await redis_client.setnx(lock_key, "1")
+    lock_key = f"pending_lock:{client_tag(cliente_id)}:{message_digest(message)}"
+    was_set = await redis_client.set(lock_key, "1", nx=True, ex=2)
     if was_set:
+        if received_at is not None:
+            await record_hop_async(redis_client, cliente_id, message.get("trace_id"), "listener", received_at)
+            if await drop_if_expired(cliente_id, message, "listener"):
+                return
         # Conseguiu o lock => armazena a mensagem
         await store_pending_message(cliente_id, message)
-        # Expira o lock em poucos segundos
-        await redis_client.expire(lock_key, 2)
     else:
         # Outro worker já armazenou
         logging.debug(f"[STORE_OFFLINE] Lock já ocupado para {cliente_id}, não armazenando duplicado.")
 
+# -----------------------------------------------------------------------------
+# Deduplicação de ações em andamento
+# -----------------------------------------------------------------------------
+# A chave guarda o hash de 'action_params' da ação em andamento: só uma ação
+# idêntica é colapsada. Com a mesma 'coalesce_key' e parâmetros diferentes
+# (ex: outro período), a mais nova passa e vira a ação em andamento.
+# Retorno: 1 = liberada, 0 = ação idêntica já em andamento.
+CLAIM_INFLIGHT_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+"""
+
+claim_inflight_script = redis_client.register_script(CLAIM_INFLIGHT_LUA)
+
+async def claim_inflight(cliente_id: int, message: dict) -> bool:
+    """
+    Marca a ação com 'coalesce_key' como em andamento para o cliente.
+    Retorna False se uma ação idêntica (mesma chave e mesmos 'action_params')
+    já foi enviada e ainda não concluiu (nem expirou INFLIGHT_DEDUP_TTL);
+    mensagens sem chave sempre passam.
+    """
+    coalesce_key = message.get("coalesce_key")
+    if not coalesce_key or INFLIGHT_DEDUP_TTL <= 0:
+        return True
+    inflight_key = f"inflight:{client_tag(cliente_id)}:{coalesce_key}"
+    action_digest = hashlib.sha1(str(message.get("action_params", "")).encode("utf-8")).hexdigest()
+    return bool(await claim_inflight_script(keys=[inflight_key], args=[action_digest, INFLIGHT_DEDUP_TTL]))
+
+async def release_inflight(cliente_id: int, coalesce_key: str):
+    """Libera a ação quando o cliente confirma a execução ('action_done')."""
+    await redis_client.delete(f"inflight:{client_tag(cliente_id)}:{coalesce_key}")
+
+# -----------------------------------------------------------------------------
+# Limite de taxa por cliente (token bucket no Redis, compartilhado entre workers)
+# -----------------------------------------------------------------------------
+# Envios por minuto e rajada máxima padrão; 0 por minuto = sem limite. Cada
+# cliente pode ter limites próprios em 'rate_limit_config:{cliente_id}'
+# (rotas /rate_limits). Mensagens acima do limite vão para as pendentes e são
+# liberadas pela drenagem conforme os tokens voltam; nada é descartado.
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "0"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "10"))
+# Espera máxima (s) da drenagem entre tentativas, para reagir a desconexão e desligamento
+RATE_LIMIT_MAX_SLEEP = float(os.getenv("RATE_LIMIT_MAX_SLEEP", "1"))
+
+# KEYS[1] = estado do balde (tokens, ts), KEYS[2] = limites do cliente (per_minute, burst)
+# ARGV: per_minute padrão, burst padrão, custo (1 consome, -1 devolve).
+# Retorna 0 se liberado (token consumido) ou quantos ms faltam para o próximo token.
+# Usa o relógio do Redis para que todos os workers vejam o mesmo tempo.
+TAKE_TOKEN_LUA = """
+local per_minute = tonumber(redis.call('HGET', KEYS[2], 'per_minute') or ARGV[1])
+local burst = tonumber(redis.call('HGET', KEYS[2], 'burst') or ARGV[2])
+if per_minute <= 0 or burst <= 0 then
+    return 0
+end
+local rate = per_minute / 60000
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local cost = tonumber(ARGV[3])
+local wait = 0
+if cost > 0 and tokens < cost then
+    wait = math.ceil((cost - tokens) / rate)
+else
+    tokens = math.min(burst, tokens - cost)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate) + 1000)
+return wait
+"""
+
+take_token_script = redis_client.register_script(TAKE_TOKEN_LUA)
+
+def rate_limit_key(cliente_id: int) -> str:
+    return f"rate_limit:{client_tag(cliente_id)}"
+
+def rate_limit_config_key(cliente_id: int) -> str:
+    return f"rate_limit_config:{client_tag(cliente_id)}"
+
+async def take_token(cliente_id: int) -> int:
+    """Consome um token do cliente. Retorna 0 se liberado ou os ms até o próximo token."""
+    return int(await take_token_script(
+        keys=[rate_limit_key(cliente_id), rate_limit_config_key(cliente_id)],
+        args=[RATE_LIMIT_PER_MINUTE, RATE_LIMIT_BURST, 1]
+    ))
+
+async def refund_token(cliente_id: int):
+    """Devolve o token de um envio que não aconteceu."""
+    await take_token_script(
+        keys=[rate_limit_key(cliente_id), rate_limit_config_key(cliente_id)],
+        args=[RATE_LIMIT_PER_MINUTE, RATE_LIMIT_BURST, -1]
+    )
+
+# -----------------------------------------------------------------------------
+# Mensagens vencidas ('deadline', ver deadlines.py)
+# -----------------------------------------------------------------------------
+async def drop_if_expired(cliente_id: int, message: dict, stage: str) -> bool:
+    """Se a mensagem venceu, conta na etapa e retorna True (quem chamou a descarta)."""
+    if not is_expired(message):
+        return False
+    if message.get("coalesce_key"):
+        await release_inflight(cliente_id, message["coalesce_key"])
+    await count_expired_async(redis_client, stage)
+    await record_hop_async(redis_client, cliente_id, message.get("trace_id"), "expired", expired_stage=stage)
+    logging.info(f"[DEADLINE] Mensagem vencida descartada ({stage}) para cliente {cliente_id}: {message}")
+    return True
+
+# -----------------------------------------------------------------------------
+# Recebe respostas do DesbravadorConnect reenviadas pelo cliente em chunks
+# -----------------------------------------------------------------------------
+def _append_response_chunk(path: str, chunk: bytes) -> int:
+    """
+    Anexa o chunk ao arquivo da resposta. Se a resposta passar de RESPONSE_MAX_BYTES,
+    apaga o parcial e deixa um marcador '.rejected' (vazio) para ignorar os chunks seguintes.
+    Retorno: 1 = anexado, -1 = resposta recusada agora, 0 = resposta já recusada.
+    """
+    rejected = path + ".rejected"
+    if os.path.exists(rejected):
+        return 0
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    if RESPONSE_MAX_BYTES and size + len(chunk) > RESPONSE_MAX_BYTES:
+        open(rejected, "wb").close()
+        if os.path.exists(path):
+            os.remove(path)
+        return -1
+    with open(path, "ab") as f:
+        f.write(chunk)
+    return 1
+
+def _discard_response(path: str):
+    for name in (path, path + ".rejected"):
+        if os.path.exists(name):
+            os.remove(name)
+
+def prune_responses(directory: str, max_age: int, max_total_bytes: int) -> int:
+    """
+    Aplica a retenção ao diretório de respostas: remove os arquivos mais velhos que
+    max_age (s) e, enquanto o total passar de max_total_bytes, os mais antigos.
+    Retorna quantos arquivos foram removidos.
+    """
+    try:
+        entries = [entry for entry in os.scandir(directory) if entry.is_file()]
+    except FileNotFoundError:
+        return 0
+    files = []
+    for entry in entries:
+        try:
+            st = entry.stat()
+        except FileNotFoundError:
+            continue
+        files.append((st.st_mtime, st.st_size, entry.path))
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    now = time.time()
+    removed = 0
+    for mtime, size, path in files:
+        expired = max_age and now - mtime > max_age
+        over_budget = max_total_bytes and total > max_total_bytes
+        if not expired and not over_budget:
+            # Ordenados do mais antigo: os seguintes também estão dentro dos limites
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    return removed
+
+def _response_path(cliente_id: int, request_id: str) -> str:
+    # request_id vem do cliente: mantém apenas caracteres seguros para nome de arquivo
+    safe_id = "".join(c for c in str(request_id) if c.isalnum() or c in "-_")
+    return os.path.join(RESPONSES_DIR, f"{cliente_id}_{safe_id}.resp")
+
+async def handle_client_frame(cliente_ids: Set[int], raw: str):
+    """
+    Trata frames enviados pelo cliente. 'response_chunk' é anexado em disco
+    (sem acumular em memória, até RESPONSE_MAX_BYTES por resposta) e
+    'response_end' registra só tamanho e hash.
+    O frame indica o 'cliente_id', que precisa ser um dos registrados na conexão.
+    """
+    try:
+        frame = json.loads(raw)
+    except Exception:
+        logging.debug(f"[WEBSOCKET] Frame não-JSON dos clientes {cliente_ids} ignorado.")
+        return
+    if not isinstance(frame, dict):
+        return
+
+    cliente_id = frame.get("cliente_id")
+    if cliente_id not in cliente_ids:
+        logging.warning(f"[WEBSOCKET] Frame para cliente {cliente_id} não registrado nesta conexão ignorado.")
+        return
+
+    frame_type = frame.get("type")
+    if frame_type == "action_expired":
+        # Subscriber recebeu a ação já vencida e não a executou
+        if frame.get("coalesce_key"):
+            await release_inflight(cliente_id, frame["coalesce_key"])
+        await count_expired_async(redis_client, "subscriber")
+        await record_hop_async(redis_client, cliente_id, frame.get("trace_id"), "expired", expired_stage="subscriber")
+    elif frame_type == "action_done":
+        if frame.get("coalesce_key"):
+            await release_inflight(cliente_id, frame["coalesce_key"])
+        extra = {"exec_ms": frame["exec_ms"]} if frame.get("exec_ms") is not None else {}
+        await record_hop_async(redis_client, cliente_id, frame.get("trace_id"), "completed", **extra)
+        logging.debug(f"[WEBSOCKET] Cliente {cliente_id} concluiu ação {frame.get('coalesce_key')}.")
+    elif frame_type == "response_chunk":
+        path = _response_path(cliente_id, frame.get("request_id"))
+        chunk = base64.b64decode(frame.get("data", ""))
+        os.makedirs(RESPONSES_DIR, exist_ok=True)
+        if await asyncio.to_thread(_append_response_chunk, path, chunk) == -1:
+            logging.warning(
+                f"[RESPOSTA] Cliente {cliente_id} resposta {frame.get('request_id')} passou de "
+                f"RESPONSE_MAX_BYTES ({RESPONSE_MAX_BYTES}); restante será descartado."
+            )
+    elif frame_type == "response_end":
+        path = _response_path(cliente_id, frame.get("request_id"))
+        if frame.get("error"):
+            logging.error(f"[RESPOSTA] Cliente {cliente_id} abortou resposta {frame.get('request_id')}: {frame['error']}")
+            await asyncio.to_thread(_discard_response, path)
+            return
+        if os.path.exists(path + ".rejected"):
+            logging.error(
+                f"[RESPOSTA] Cliente {cliente_id} resposta {frame.get('request_id')} descartada: "
+                f"{frame.get('size')} bytes, acima de RESPONSE_MAX_BYTES ({RESPONSE_MAX_BYTES})."
+            )
+            await asyncio.to_thread(_discard_response, path)
+            return
+        logging.info(
+            f"[RESPOSTA] Cliente {cliente_id} resposta {frame.get('request_id')}: "
+            f"{frame.get('size')} bytes em {frame.get('chunks')} chunks, sha256={frame.get('sha256')}"
+        )
+
+# -----------------------------------------------------------------------------
+# Fila de saída por conexão, com filas de prioridade
+# -----------------------------------------------------------------------------
+class OutboundQueue:
+    """
+    Único ponto de envio de mensagens de um socket. Cada fila de prioridade
+    tem até OUTBOUND_QUEUE_SIZE itens; uma task serve as filas via LanePicker.
+    Falhas de envio devolvem a mensagem às pendentes.
+    """
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.lanes = {lane: asyncio.Queue(OUTBOUND_QUEUE_SIZE) for lane in PRIORITY_LANES}
+        self.items = asyncio.Semaphore(0)
+        self.picker = LanePicker()
+        self.sending = False
+        self.closed = False
+        # Mensagem já retirada da fila e ainda não enviada; quem a zerar assume a
+        # entrega (o próprio envio, o tratamento de erro ou close())
+        self.current: Optional[tuple] = None
+        self.task = asyncio.create_task(self._run())
+
+    def idle(self) -> bool:
+        """True quando não há nada enfileirado nem sendo enviado."""
+        return not self.sending and all(queue.empty() for queue in self.lanes.values())
+
+    def offer(self, cliente_id: int, message: dict) -> bool:
+        """Enfileira sem bloquear; False se a fila da prioridade estiver cheia."""
+        try:
+            self.lanes[message_lane(message)].put_nowait((cliente_id, message))
+        except asyncio.QueueFull:
+            return False
+        self.items.release()
+        return True
+
+    async def put(self, cliente_id: int, message: dict):
+        """Enfileira aguardando espaço (usado pela drenagem das pendentes)."""
+        await self.lanes[message_lane(message)].put((cliente_id, message))
+        if self.closed:
+            # Fila encerrada enquanto aguardava espaço: devolve às pendentes
+            for leftover in self._take_all():
+                await requeue_pending(*leftover)
+            return
+        self.items.release()
+
+    async def _run(self):
+        # O cancelamento pode chegar convertido em outra exceção (ex: dentro do
+        # send do socket ou do cliente Redis); 'closed' garante que a task pare
+        while not self.closed:
+            await self.items.acquire()
+            available = [lane for lane, queue in self.lanes.items() if not queue.empty()]
+            if self.closed or not available:
+                continue
+            lane = self.picker.pick(available)
+            cliente_id, message = self.current = self.lanes[lane].get_nowait()
+            self.sending = True
+            try:
+                if await drop_if_expired(cliente_id, message, "send"):
+                    continue
+                logging.info(f"[WEBSOCKET] Enviando mensagem para cliente {cliente_id} no worker {MY_WORKER_ID}: {message}")
+                await self.websocket.send_json(message)
+                self.current = None
+                logging.info(f"[WEBSOCKET] Mensagem enviada para {cliente_id}")
+                await record_hop_async(redis_client, cliente_id, message.get("trace_id"), "sent")
+            except Exception as e:
+                if self.current is not None:
+                    self.current = None
+                    logging.error(f"[WEBSOCKET] Erro ao enviar mensagem para {cliente_id}: {e}. Devolvendo às pendentes.")
+                    await requeue_pending(cliente_id, message)
+            finally:
+                self.current = None
+                self.sending = False
+
+    def close(self) -> List[tuple]:
+        """
+        Interrompe o envio e retorna as mensagens que ficaram nas filas, incluindo
+        a que estava sendo enviada (o cancelamento interrompe o send_json).
+        """
+        self.closed = True
+        leftovers = [self.current] if self.current is not None else []
+        self.current = None
+        self.task.cancel()
+        return leftovers + self._take_all()
+
+    def _take_all(self) -> List[tuple]:
+        leftovers = []
+        for queue in self.lanes.values():
+            while not queue.empty():
+                leftovers.append(queue.get_nowait())
+        return leftovers
+
+async def requeue_pending(cliente_id: int, message: dict):
+    """Devolve uma mensagem não entregue às pendentes, liberando a deduplicação em andamento."""
+    if message.get("coalesce_key"):
+        await release_inflight(cliente_id, message["coalesce_key"])
+    await store_pending_message(cliente_id, message)
+
 # -----------------------------------------------------------------------------
 # Gerenciador de conexões WebSocket
 # -----------------------------------------------------------------------------
@@ -90,73 +757,213 @@ class ConnectionManager:
     """
     Armazena conexões WebSocket locais em 'active_connections'.
     Usa Redis 'active_clients' para saber se o cliente está conectado em qualquer worker.
+    Uma mesma conexão pode atender vários cliente_id (agente multi-propriedade);
+    'connection_clients' guarda quais clientes cada socket atende e 'outbound'
+    a fila de saída de cada socket.
     """
     def __init__(self, redis_client):
         self.active_connections: Dict[int, WebSocket] = {}
+        self.connection_clients: Dict[int, Set[int]] = {}
+        self.outbound: Dict[int, OutboundQueue] = {}
+        self.drain_tasks: Dict[int, asyncio.Task] = {}
+        self.drain_requested: Set[int] = set()
+        self.client_groups: Dict[int, str] = {}
+        self.draining = False
         self.redis_client = redis_client
 
-    async def connect(self, cliente_id: int, websocket: WebSocket):
+    async def connect(self, cliente_id: int, websocket: WebSocket, group: Optional[str] = None):
         """Registra a conexão do cliente neste worker; fecha se já existir duplicada."""
         if cliente_id in self.active_connections:
             logging.warning(f"[WEBSOCKET] Cliente {cliente_id} já conectado neste worker. Fechando conexão anterior...")
             await self.disconnect(cliente_id)
 
         self.active_connections[cliente_id] = websocket
-        await self.redis_client.sadd("active_clients", cliente_id)
+        self.connection_clients.setdefault(id(websocket), set()).add(cliente_id)
+        if id(websocket) not in self.outbound:
+            self.outbound[id(websocket)] = OutboundQueue(websocket)
+        await presence_add(cliente_id)
+        if group:
+            self.client_groups[cliente_id] = group
+            await self.redis_client.sadd(group_key(group), cliente_id)
         logging.info(f"[WEBSOCKET] Cliente {cliente_id} registrado no worker {MY_WORKER_ID}.")
 
+    async def connect_many(self, cliente_ids: List[int], websocket: WebSocket, group: Optional[str] = None):
+        """Registra vários clientes sobre a mesma conexão."""
+        for cliente_id in cliente_ids:
+            await self.connect(cliente_id, websocket, group)
+
+    async def _forget(self, *cliente_ids: int):
+        """Remove a presença (e o grupo) dos clientes no Redis."""
+        await presence_remove(*cliente_ids)
+        by_group: Dict[str, List[int]] = {}
+        for cliente_id in cliente_ids:
+            group = self.client_groups.pop(cliente_id, None)
+            if group:
+                by_group.setdefault(group, []).append(cliente_id)
+        for group, ids in by_group.items():
+            await self.redis_client.srem(group_key(group), *ids)
+
+    def _unregister(self, cliente_id: int, websocket: WebSocket) -> bool:
+        """Remove o cliente do mapa local. Retorna True se o socket não atende mais nenhum cliente."""
+        self.active_connections.pop(cliente_id, None)
+        clients = self.connection_clients.get(id(websocket))
+        if clients is None:
+            return True
+        clients.discard(cliente_id)
+        if not clients:
+            self.connection_clients.pop(id(websocket), None)
+            return True
+        return False
+
+    async def _release_outbound(self, websocket: WebSocket):
+        """Encerra a fila de saída do socket e devolve o que não foi enviado às pendentes."""
+        outbound = self.outbound.pop(id(websocket), None)
+        if outbound is None:
+            return
+        leftovers = outbound.close()
+        for cliente_id, message in leftovers:
+            await requeue_pending(cliente_id, message)
+        if leftovers:
+            logging.info(f"[WEBSOCKET] {len(leftovers)} mensagens não enviadas devolvidas às pendentes.")
+
+    async def _close(self, websocket: WebSocket, description: str):
+        await self._release_outbound(websocket)
+        try:
+            # Nada a fazer se o cliente já desconectou ou se o close já foi enviado
+            if WebSocketState.DISCONNECTED not in (websocket.client_state, websocket.application_state):
+                await websocket.close()
+        except Exception as e:
+            logging.error(f"[WEBSOCKET] Erro ao fechar conexão {description}: {e}")
+
     async def disconnect(self, cliente_id: int):
-        """Remove a conexão do cliente deste worker e atualiza 'active_clients' no Redis."""
+        """
+        Remove o cliente deste worker e atualiza 'active_clients' no Redis.
+        O socket só é fechado quando não atende mais nenhum outro cliente.
+        """
         ws = self.active_connections.get(cliente_id)
         if ws:
-            try:
-                if ws.client_state not in (WebSocketState.DISCONNECTED, WebSocketState.CLOSED):
-                    await ws.close()
-            except Exception as e:
-                logging.error(f"[WEBSOCKET] Erro ao fechar conexão do cliente {cliente_id}: {e}")
-
-            self.active_connections.pop(cliente_id, None)
-            await self.redis_client.srem("active_clients", cliente_id)
+            if self._unregister(cliente_id, ws):
+                await self._close(ws, f"do cliente {cliente_id}")
+            await self._forget(cliente_id)
             logging.info(f"[WEBSOCKET] Cliente {cliente_id} desconectado e removido.")
 
+    async def disconnect_connection(self, websocket: WebSocket):
+        """Remove todos os clientes atendidos por este socket (que ainda apontem para ele)."""
+        cliente_ids = [
+            cid for cid in self.connection_clients.pop(id(websocket), set())
+            if self.active_connections.get(cid) is websocket
+        ]
+        for cid in cliente_ids:
+            self.active_connections.pop(cid, None)
+        if cliente_ids:
+            await self._forget(*cliente_ids)
+            logging.info(f"[WEBSOCKET] Clientes {cliente_ids} desconectados e removidos.")
+        await self._close(websocket, f"dos clientes {cliente_ids}")
+
     async def send_message(self, cliente_id: int, message: dict):
         """
-        Se o cliente estiver conectado neste worker, envia via WebSocket.
+        Se o cliente estiver conectado neste worker, entrega à fila de saída do socket.
+        Se a fila estiver cheia (ou houver drenagem em curso, para manter a ordem),
+        guarda como pendente e agenda a drenagem.
         Caso contrário, armazena pendente (se ele estiver realmente offline).
         """
         connection = self.active_connections.get(cliente_id)
-        if connection:
-            try:
-                logging.info(f"[WEBSOCKET] Enviando mensagem para cliente {cliente_id} no worker {MY_WORKER_ID}: {message}")
-                await connection.send_json(message)
-                logging.info(f"[WEBSOCKET] Mensagem enviada para {cliente_id}")
-            except Exception as e:
-                logging.error(f"[WEBSOCKET] Erro ao enviar mensagem para {cliente_id}: {e}")
+        if connection and self.draining:
+            # Worker desligando: guarda para ser entregue após a reconexão
+            await store_pending_message(cliente_id, message)
+        elif connection:
+            if not await claim_inflight(cliente_id, message):
+                logging.info(f"[WEBSOCKET] Ação '{message.get('coalesce_key')}' já em andamento para {cliente_id}; mensagem colapsada.")
+                return
+            outbound = self.outbound[id(connection)]
+            deferred = cliente_id in self.drain_tasks
+            if not deferred and await take_token(cliente_id) > 0:
+                logging.info(f"[RATE_LIMIT] Limite de envios atingido para {cliente_id}; mensagem adiada para as pendentes.")
+                deferred = True
+            elif not deferred and not outbound.offer(cliente_id, message):
+                await refund_token(cliente_id)
+                deferred = True
+            if deferred:
+                logging.debug(f"[WEBSOCKET] Fila de saída ocupada para {cliente_id}; mensagem vai para as pendentes.")
+                await requeue_pending(cliente_id, message)
+                self.ensure_drain(cliente_id)
         else:
             # Não está conectado aqui => vamos conferir se está offline
             logging.warning(f"[WEBSOCKET] Cliente {cliente_id} não está conectado neste worker {MY_WORKER_ID}.")
             await store_message_if_offline(cliente_id, message)
 
-    async def send_pending_messages(self, cliente_id: int, websocket: WebSocket):
+    def ensure_drain(self, cliente_id: int):
+        """Garante uma drenagem das pendentes do cliente (uma task por cliente)."""
+        self.drain_requested.add(cliente_id)
+        if cliente_id not in self.drain_tasks:
+            self.drain_tasks[cliente_id] = asyncio.create_task(self._drain_loop(cliente_id))
+
+    async def _drain_loop(self, cliente_id: int):
+        try:
+            # Repete enquanto novas drenagens forem pedidas durante a passada atual
+            while cliente_id in self.drain_requested:
+                self.drain_requested.discard(cliente_id)
+                await self.send_pending_messages(cliente_id)
+        finally:
+            self.drain_requested.discard(cliente_id)
+            self.drain_tasks.pop(cliente_id, None)
+
+    async def send_pending_messages(self, cliente_id: int):
         """
-        Lê a lista 'pending_messages:{cliente_id}' no Redis e envia tudo ao cliente.
+        Lê as filas 'pending_messages:{cliente_id}' no Redis e entrega tudo à
+        fila de saída do cliente, servindo primeiro as filas mais prioritárias.
+        Cada envio consome um token do limite de taxa; sem token, espera ele voltar.
+        Uma fila vazia só sai da passada até o próximo envio.
         """
-        key = f"pending_messages:{cliente_id}"
-        while True:
-            message = await self.redis_client.lpop(key)
+        picker = LanePicker()
+        lanes = list(PRIORITY_LANES)
+        # Token já consumido e ainda não usado (pendente vencida, colapsada...)
+        has_token = False
+        while lanes and not self.draining:
+            if not has_token:
+                wait_ms = await take_token(cliente_id)
+                if wait_ms > 0:
+                    if cliente_id not in self.active_connections:
+                        break
+                    await asyncio.sleep(min(wait_ms / 1000, RATE_LIMIT_MAX_SLEEP))
+                    continue
+                has_token = True
+            lane = picker.pick(lanes)
+            message = await pop_pending_message(cliente_id, lane)
             if message is None:
-                logging.debug(f"[PENDENTES] Fim das mensagens pendentes para cliente {cliente_id}.")
-                break
+                lanes.remove(lane)
+                continue
+            if not message:
+                continue
 
             logging.debug(f"[PENDENTES] Lido do Redis para {cliente_id}: {message}")
             try:
-                data = json.loads(message)
-                await websocket.send_json(data)
-                logging.info(f"[WEBSOCKET] Mensagem pendente enviada para {cliente_id}: {data}")
+                data = decode_pending(message)
             except Exception as e:
-                logging.error(f"[PENDENTES] Erro ao enviar pendente para {cliente_id}: {e}")
-                # Opcional: reempilhar a mensagem
+                logging.error(f"[PENDENTES] Pendente inválida descartada para {cliente_id}: {e}")
+                continue
+            if await drop_if_expired(cliente_id, data, "pending_drain"):
+                continue
+
+            connection = self.active_connections.get(cliente_id)
+            outbound = self.outbound.get(id(connection)) if connection else None
+            if outbound is None:
+                # Cliente saiu durante a drenagem: devolve e para
+                await store_pending_message(cliente_id, data)
+                logging.info(f"[PENDENTES] Cliente {cliente_id} desconectou durante a drenagem.")
                 break
+            if not await claim_inflight(cliente_id, data):
+                logging.info(f"[PENDENTES] Ação '{data.get('coalesce_key')}' já em andamento para {cliente_id}; pendente colapsada.")
+                continue
+            await outbound.put(cliente_id, data)
+            has_token = False
+            # Filas esvaziadas voltam a ser consultadas a cada envio: uma mensagem
+            # interativa que chegou durante a drenagem não espera a fila bulk acabar
+            lanes = list(PRIORITY_LANES)
+            logging.info(f"[WEBSOCKET] Mensagem pendente enfileirada para {cliente_id}: {data}")
+        if has_token:
+            await refund_token(cliente_id)
+        logging.debug(f"[PENDENTES] Fim das mensagens pendentes para cliente {cliente_id}.")
 
     async def cleanup_inactive_connections(self):
         """
@@ -168,20 +975,70 @@ class ConnectionManager:
         ]
         for cid in disconnected_clients:
             logging.info(f"[WEBSOCKET] Removendo cliente desconectado {cid}")
-            self.active_connections.pop(cid, None)
-            await self.redis_client.srem("active_clients", cid)
+            ws = self.active_connections[cid]
+            if self._unregister(cid, ws):
+                await self._release_outbound(ws)
+            await self._forget(cid)
+
+    async def shutdown(self):
+        """
+        Desligamento sem perda:
+        1. para de aceitar conexões e de drenar pendentes ('draining');
+        2. aguarda as filas de saída esvaziarem (até SHUTDOWN_FLUSH_TIMEOUT);
+        3. devolve o que não foi enviado às pendentes;
+        4. remove a presença dos clientes deste worker em 'active_clients';
+        5. envia a cada socket um frame 'reconnect' com atraso aleatório e fecha
+           (todos ao mesmo tempo, até SHUTDOWN_CLOSE_TIMEOUT cada).
+        """
+        self.draining = True
+        if self.drain_tasks:
+            await asyncio.wait(list(self.drain_tasks.values()), timeout=SHUTDOWN_FLUSH_TIMEOUT)
+
+        try:
+            await asyncio.wait_for(self._flush(), timeout=SHUTDOWN_FLUSH_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning(f"[SHUTDOWN] Filas de saída não esvaziaram em {SHUTDOWN_FLUSH_TIMEOUT}s; restante volta às pendentes.")
+
+        sockets = {id(ws): ws for ws in self.active_connections.values()}
+        for ws in sockets.values():
+            await self._release_outbound(ws)
+
+        cliente_ids = list(self.active_connections)
+        if cliente_ids:
+            await self._forget(*cliente_ids)
+        await self.redis_client.hdel(WORKERS_PRESENCE_KEY, MY_WORKER_ID)
+        self.active_connections.clear()
+        self.connection_clients.clear()
+
+        await asyncio.gather(*(self._say_goodbye(ws) for ws in sockets.values()))
+        logging.info(f"[SHUTDOWN] Worker {MY_WORKER_ID} drenado: {len(cliente_ids)} clientes em {len(sockets)} sockets.")
+
+    async def _say_goodbye(self, websocket: WebSocket):
+        """Envia o 'reconnect' e fecha o socket; um par travado não segura os demais."""
+        try:
+            await asyncio.wait_for(reject_draining(websocket), timeout=SHUTDOWN_CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.debug(f"[SHUTDOWN] Socket não fechou em {SHUTDOWN_CLOSE_TIMEOUT}s; abandonado.")
+        except Exception as e:
+            logging.debug(f"[SHUTDOWN] Erro ao avisar/fechar socket: {e}")
+
+    async def _flush(self):
+        while not all(outbound.idle() for outbound in self.outbound.values()):
+            await asyncio.sleep(0.05)
 
     async def send_keepalive(self):
         """
-        Envia pings periódicos. Se falhar, faz 'disconnect', liberando o Redis.
+        Envia pings periódicos, um por socket (não por cliente).
+        Se falhar, desconecta todos os clientes do socket, liberando o Redis.
         """
-        for cliente_id, ws in list(self.active_connections.items()):
+        sockets = {id(ws): ws for ws in self.active_connections.values()}
+        for ws in sockets.values():
             try:
                 await ws.send_text("ping")
-                logging.debug(f"[KEEPALIVE] Ping enviado para cliente {cliente_id}")
+                logging.debug(f"[KEEPALIVE] Ping enviado para clientes {self.connection_clients.get(id(ws))}")
             except Exception as e:
-                logging.error(f"[KEEPALIVE] Erro ao enviar ping para {cliente_id}: {e}")
-                await self.disconnect(cliente_id)
+                logging.error(f"[KEEPALIVE] Erro ao enviar ping para {self.connection_clients.get(id(ws))}: {e}")
+                await self.disconnect_connection(ws)
 
 # -----------------------------------------------------------------------------
 # Instância do FastAPI e Manager
@@ -190,21 +1047,176 @@ app = FastAPI()
 connection_manager = ConnectionManager(redis_client)
 
 # -----------------------------------------------------------------------------
-# Rota simples para ver clientes
+# Inventário de clientes conectados
 # -----------------------------------------------------------------------------
+_inventory_cache = {"expires": 0.0, "data": None}
+_inventory_lock = asyncio.Lock()
+
+async def inventory_snapshot() -> dict:
+    """
+    Snapshot do inventário (lista completa, total e contadores por worker),
+    reconstruído no máximo a cada INVENTORY_CACHE_TTL segundos por worker,
+    com SSCAN incremental em vez de um SMEMBERS bloqueante.
+    """
+    async with _inventory_lock:
+        if _inventory_cache["data"] is None or time.monotonic() >= _inventory_cache["expires"]:
+            clients, cursor = [], "0"
+            while True:
+                cursor, members = await presence_page(cursor, 1000)
+                clients.extend(members)
+                if cursor == "0":
+                    break
+            _inventory_cache["data"] = {
+                "connected_clients": clients,
+                "total": len(clients),
+                "workers": await workers_presence(),
+                "generated_at": int(time.time())
+            }
+            _inventory_cache["expires"] = time.monotonic() + INVENTORY_CACHE_TTL
+        return _inventory_cache["data"]
+
 @app.get("/connected_clients")
 async def get_connected_clients():
-    """Retorna a lista de clientes conectados (em qualquer worker)."""
-    clients = await redis_client.smembers("active_clients")
-    return {"connected_clients": list(clients)}
+    """
+    Retorna a lista de clientes conectados (em qualquer worker), a partir do
+    snapshot em cache (até INVENTORY_CACHE_TTL segundos de atraso).
+    """
+    return await inventory_snapshot()
+
+@app.get("/connected_clients/count")
+async def get_connected_clients_count():
+    """Contadores baratos: total (SCARD) e por worker."""
+    return {"total": await presence_total(), "workers": await workers_presence()}
+
+@app.get("/connected_clients/page")
+async def get_connected_clients_page(
+    cursor: str = "0", count: int = 500,
+    min_id: Optional[int] = None, max_id: Optional[int] = None, group: Optional[str] = None
+):
+    """
+    Inventário paginado por cursor (SSCAN). Use o 'cursor' retornado até que
+    ele volte a "0"; páginas podem vir vazias por causa dos filtros.
+    """
+    next_cursor, members = await presence_page(cursor, count, group)
+    clients = [int(member) for member in members]
+    if min_id is not None:
+        clients = [cid for cid in clients if cid >= min_id]
+    if max_id is not None:
+        clients = [cid for cid in clients if cid <= max_id]
+    return {"cursor": next_cursor, "connected_clients": sorted(clients)}
+
+# -----------------------------------------------------------------------------
+# Rotas de administração: memória das pendentes por cliente
+# -----------------------------------------------------------------------------
+@app.get("/pending_memory")
+async def get_pending_memory(cursor: str = "0", count: int = 100):
+    """
+    Lista a ocupação das pendentes por cliente, paginada com SCAN.
+    Use o 'cursor' retornado até que ele volte a "0".
+    """
+    next_cursor, keys = await scan_page(redis_client, cursor, "pending_messages:*", count)
+    cliente_ids = sorted({int(k.split(":")[1].strip("{}")) for k in keys})
+    clients = [await pending_memory_usage(cid) for cid in cliente_ids]
+    return {
+        "cursor": next_cursor,
+        "clients": clients,
+        "bytes": sum(c["bytes"] for c in clients),
+        "max_per_client": PENDING_MAX_PER_CLIENT,
+        "overflow_policy": PENDING_OVERFLOW_POLICY
+    }
+
+@app.get("/pending_memory/{cliente_id}")
+async def get_pending_memory_client(cliente_id: int):
+    """Ocupação das pendentes de um cliente."""
+    return await pending_memory_usage(cliente_id)
+
+@app.get("/expired_stats")
+async def get_expired_stats():
+    """Mensagens descartadas por vencimento, por etapa."""
+    stats = await redis_client.hgetall(EXPIRED_STATS_KEY)
+    return {stage: int(count) for stage, count in stats.items()}
+
+# -----------------------------------------------------------------------------
+# Rotas de administração: limite de taxa por cliente
+# -----------------------------------------------------------------------------
+@app.get("/rate_limits/{cliente_id}")
+async def get_rate_limit(cliente_id: int):
+    """Limites em vigor para o cliente e tokens disponíveis no último uso."""
+    config = await redis_client.hgetall(rate_limit_config_key(cliente_id))
+    state = await redis_client.hgetall(rate_limit_key(cliente_id))
+    return {
+        "cliente_id": cliente_id,
+        "per_minute": float(config.get("per_minute", RATE_LIMIT_PER_MINUTE)),
+        "burst": int(config.get("burst", RATE_LIMIT_BURST)),
+        "custom": bool(config),
+        "tokens": float(state["tokens"]) if state else None
+    }
+
+@app.put("/rate_limits/{cliente_id}")
+async def set_rate_limit(cliente_id: int, per_minute: float, burst: Optional[int] = None):
+    """Define limites próprios do cliente (per_minute=0 remove o limite). Vale no próximo envio."""
+    if per_minute < 0 or (burst is not None and burst < 1):
+        raise HTTPException(status_code=400, detail="per_minute deve ser >= 0 e burst >= 1")
+    await redis_client.hset(rate_limit_config_key(cliente_id), mapping={
+        "per_minute": per_minute,
+        "burst": burst if burst is not None else RATE_LIMIT_BURST
+    })
+    return await get_rate_limit(cliente_id)
+
+@app.delete("/rate_limits/{cliente_id}")
+async def delete_rate_limit(cliente_id: int):
+    """Volta o cliente aos limites padrão (RATE_LIMIT_PER_MINUTE / RATE_LIMIT_BURST)."""
+    await redis_client.delete(rate_limit_config_key(cliente_id))
+    return await get_rate_limit(cliente_id)
+
+# -----------------------------------------------------------------------------
+# Rotas de rastreamento: tempo gasto em cada etapa da mensagem
+# -----------------------------------------------------------------------------
+@app.get("/traces/{trace_id}")
+async def get_trace(trace_id: str):
+    """Carimbos e tempo entre etapas de uma mensagem."""
+    trace = await redis_client.hgetall(trace_key(trace_id))
+    if not trace:
+        raise HTTPException(status_code=404, detail="Trace não encontrado")
+    return {"trace_id": trace_id, "hops": trace, "breakdown": hop_breakdown(trace)}
+
+@app.get("/traces/client/{cliente_id}")
+async def get_client_traces(cliente_id: int, limit: int = 50):
+    """Últimos traces do cliente e estatísticas dos trechos mais lentos."""
+    trace_ids = await redis_client.lrange(client_traces_key(cliente_id), 0, limit - 1)
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for trace_id in trace_ids:
+            pipe.hgetall(trace_key(trace_id))
+        traces = await pipe.execute()
+    items = [
+        {"trace_id": trace_id, "hops": trace, "breakdown": hop_breakdown(trace)}
+        for trace_id, trace in zip(trace_ids, traces) if trace
+    ]
+    return {
+        "cliente_id": cliente_id,
+        "traces": items,
+        "stats": slowest_hop_stats([item["breakdown"] for item in items])
+    }
 
 # -----------------------------------------------------------------------------
 # WebSocket
 # -----------------------------------------------------------------------------
+async def reject_draining(websocket: WebSocket):
+    """Worker em desligamento: pede ao cliente que reconecte (em outro worker) após um atraso aleatório."""
+    await websocket.send_json({
+        "type": "reconnect",
+        "reason": "shutdown",
+        "delay": round(random.uniform(1, RECONNECT_SPREAD), 1)
+    })
+    await websocket.close(code=1012)
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """Recebe conexão WS, autentica e envia pendências."""
     await websocket.accept()
+    if connection_manager.draining:
+        await reject_draining(websocket)
+        return
     try:
         init_message = await asyncio.wait_for(websocket.receive_text(), timeout=5)
     except asyncio.TimeoutError:
@@ -224,53 +1236,77 @@ async def websocket_endpoint(websocket: WebSocket):
         await websocket.close()
         return
 
-    if not data or not data.get("cliente_id") or not data.get("username") or not data.get("password"):
+    if not isinstance(data, dict) or not (data.get("cliente_id") or data.get("cliente_ids")) \
+            or not data.get("username") or not data.get("password"):
         await websocket.send_text("Erro: Dados de autenticação incompletos.")
         await websocket.close()
         return
 
-    cliente_id = data["cliente_id"]
+    # Aceita um único 'cliente_id' ou uma lista 'cliente_ids' (agente multi-propriedade)
+    cliente_ids = data.get("cliente_ids") or [data["cliente_id"]]
     username = data["username"]
     password = data["password"]
 
-    if not isinstance(cliente_id, int):
+    if not isinstance(cliente_ids, list) or not all(isinstance(cid, int) and not isinstance(cid, bool) for cid in cliente_ids):
         await websocket.send_text("Erro: Cliente ID inválido.")
         await websocket.close()
         return
 
+    cliente_ids = list(dict.fromkeys(cliente_ids))
+    group = data.get("group")
+    if group is not None and not isinstance(group, str):
+        await websocket.send_text("Erro: Grupo inválido.")
+        await websocket.close()
+        return
+    if len(cliente_ids) > MAX_CLIENTS_PER_CONNECTION:
+        await websocket.send_text(f"Erro: Máximo de {MAX_CLIENTS_PER_CONNECTION} clientes por conexão.")
+        await websocket.close()
+        return
+
     if not authenticate(username, password):
         await websocket.send_text("Erro: Credenciais inválidas.")
         await websocket.close()
         return
 
-    # Conecta localmente e adiciona no 'active_clients'
-    await connection_manager.connect(cliente_id, websocket)
+    if connection_manager.draining:
+        await reject_draining(websocket)
+        return
 
-    # Envia pendências, se houver
-    await connection_manager.send_pending_messages(cliente_id, websocket)
+    try:
+        # Conecta localmente e adiciona no 'active_clients'
+        await connection_manager.connect_many(cliente_ids, websocket, group)
 
-    # Confirma
-    await websocket.send_text(f"OK: Conexão autenticada no worker {MY_WORKER_ID}.")
+        # Envia pendências, se houver (em background, pela fila de saída do socket)
+        for cliente_id in cliente_ids:
+            connection_manager.ensure_drain(cliente_id)
+
+        # Confirma
+        await websocket.send_text(f"OK: Conexão autenticada no worker {MY_WORKER_ID}.")
 
-    try:
         while True:
-            await websocket.receive_text()  # Bloqueia esperando mensagens do cliente
+            raw = await websocket.receive_text()  # Bloqueia esperando mensagens do cliente
+            await handle_client_frame(connection_manager.connection_clients.get(id(websocket), set()), raw)
     except WebSocketDisconnect:
-        await connection_manager.disconnect(cliente_id)
-        logging.warning(f"[WEBSOCKET] Cliente {cliente_id} desconectado do worker {MY_WORKER_ID}.")
+        logging.warning(f"[WEBSOCKET] Clientes {cliente_ids} desconectados do worker {MY_WORKER_ID}.")
+    except Exception as e:
+        # Ex: socket fechado por outra conexão dos mesmos clientes durante o handshake
+        logging.warning(f"[WEBSOCKET] Conexão dos clientes {cliente_ids} encerrada no worker {MY_WORKER_ID}: {e}")
+    finally:
+        # Sempre limpa o estado do socket, senão ele fica em 'connection_clients' e 'outbound'
+        await connection_manager.disconnect_connection(websocket)
 
 # -----------------------------------------------------------------------------
 # redis_listener: lê pubsub e despacha mensagens
 # -----------------------------------------------------------------------------
 async def redis_listener():
-    pubsub = redis_client.pubsub()
-    await pubsub.subscribe(CHANNEL)
-    logging.info(f"[REDIS] Worker {MY_WORKER_ID} assinou no canal Redis '{CHANNEL}'. Aguardando mensagens...")
+    pubsub, get_message = await subscribe_events(redis_client)
+    logging.info(f"[REDIS] Worker {MY_WORKER_ID} assinou os canais Redis {event_channels()}. Aguardando mensagens...")
 
     while True:
         try:
-            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
-            if message and message["type"] == "message":
+            message = await get_message(ignore_subscribe_messages=True, timeout=1.0)
+            if message and message["type"] in ("message", "smessage"):
+                received_at = now_ms()
                 data = json.loads(message["data"])
                 cliente_id = data.get("cliente_id")
 
@@ -281,20 +1317,23 @@ async def redis_listener():
                 # Se este worker tem o cliente, envia
                 if cliente_id in connection_manager.active_connections:
                     logging.info(f"[REDIS] Worker {MY_WORKER_ID} processará mensagem: {data}")
+                    await record_hop_async(redis_client, cliente_id, data.get("trace_id"), "listener", received_at)
+                    if await drop_if_expired(cliente_id, data, "listener"):
+                        continue
                     await connection_manager.send_message(cliente_id, data)
                 else:
                     # Cliente não está neste worker
-                    in_cluster = await redis_client.sismember("active_clients", cliente_id)
+                    in_cluster = await presence_contains(cliente_id)
                     if not in_cluster:
                         # Offline => armazena
                         logging.info(f"[REDIS] Worker {MY_WORKER_ID}: {cliente_id} não está em active_clients. Armazenando pendente.")
-                        await store_message_if_offline(cliente_id, data)
+                        await store_message_if_offline(cliente_id, data, received_at)
                     else:
                         # Conectado em outro worker
                         logging.debug(f"[REDIS] Mensagem para {cliente_id} ignorada por {MY_WORKER_ID}; cliente conectado em outro worker.")
         except Exception as e:
             logging.error(f"[REDIS] Erro ao processar mensagem no worker {MY_WORKER_ID}: {e}")
-        await asyncio.sleep(0.1)
+            await asyncio.sleep(0.1)
 
 # -----------------------------------------------------------------------------
 # Tarefas assíncronas extras
@@ -302,8 +1341,24 @@ async def redis_listener():
 async def cleanup_inactive_connections_task():
     while True:
         await connection_manager.cleanup_inactive_connections()
+        if not connection_manager.draining:
+            await report_worker_presence(
+                len(connection_manager.active_connections), len(connection_manager.connection_clients)
+            )
         await asyncio.sleep(10)
 
+async def prune_responses_task():
+    while True:
+        try:
+            removed = await asyncio.to_thread(
+                prune_responses, RESPONSES_DIR, RESPONSES_MAX_AGE, RESPONSES_MAX_TOTAL_BYTES
+            )
+            if removed:
+                logging.info(f"[RESPOSTA] Retenção: {removed} arquivos removidos de {RESPONSES_DIR}.")
+        except Exception as e:
+            logging.error(f"[RESPOSTA] Erro ao aplicar a retenção em {RESPONSES_DIR}: {e}")
+        await asyncio.sleep(RESPONSES_PRUNE_INTERVAL)
+
 async def keepalive_task():
     while True:
         await connection_manager.send_keepalive()
@@ -312,14 +1367,60 @@ async def keepalive_task():
 # -----------------------------------------------------------------------------
 # Eventos de ciclo de vida
 # -----------------------------------------------------------------------------
+async def graceful_shutdown():
+    """Executa a drenagem do worker uma única vez."""
+    if connection_manager.draining:
+        return
+    logging.info(f"[APP] Drenando worker {MY_WORKER_ID}...")
+    await connection_manager.shutdown()
+
+def install_drain_signal_handlers():
+    """
+    O uvicorn fecha os websockets antes do evento 'shutdown', então a drenagem
+    precisa rodar ao receber o sinal: o handler agenda graceful_shutdown() e só
+    depois repassa o sinal ao handler original do uvicorn.
+    Um segundo sinal durante a drenagem é repassado imediatamente.
+    Fora da thread principal (ex: TestClient) sinais não podem ser instalados;
+    como no capture_signals do uvicorn, o gancho é pulado.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        previous = signal.getsignal(sig)
+        if not callable(previous):
+            continue
+
+        def handler(signum, frame, previous=previous):
+            if connection_manager.draining:
+                previous(signum, frame)
+                return
+
+            async def drain_then_exit():
+                try:
+                    await asyncio.wait_for(graceful_shutdown(), timeout=SHUTDOWN_TOTAL_TIMEOUT)
+                except asyncio.TimeoutError:
+                    logging.warning(f"[SHUTDOWN] Drenagem não terminou em {SHUTDOWN_TOTAL_TIMEOUT}s; encerrando assim mesmo.")
+                except Exception as e:
+                    logging.error(f"[SHUTDOWN] Erro na drenagem: {e}")
+                finally:
+                    previous(signum, frame)
+
+            loop.call_soon_threadsafe(lambda: asyncio.ensure_future(drain_then_exit()))
+
+        signal.signal(sig, handler)
+
 @app.on_event("startup")
 async def on_startup():
     logging.info(f"[APP] Iniciando worker {MY_WORKER_ID}...")
     asyncio.create_task(redis_listener())
     asyncio.create_task(cleanup_inactive_connections_task())
     asyncio.create_task(keepalive_task())
+    asyncio.create_task(prune_responses_task())
+    install_drain_signal_handlers()
     logging.info(f"[APP] Startup: Tarefas de listener, cleanup e keepalive inicializadas no worker {MY_WORKER_ID}.")
 
 @app.on_event("shutdown")
 async def on_shutdown():
-    logging.info(f"[APP] Shutdown event: Worker {MY_WORKER_ID} finalizando.")
\ No newline at end of file
+    await graceful_shutdown()
+    logging.info(f"[APP] Shutdown event: Worker {MY_WORKER_ID} finalizando.")
@@ -1,4 +1,7 @@
 import asyncio
+import base64
+import hashlib
+import uuid
 import websockets
 import json
 import os
@@ -10,6 +13,7 @@ import win32event
 import win32service
 import win32serviceutil
 import threading
+import time
 import traceback
 from dotenv import load_dotenv
 import logging
@@ -27,6 +31,10 @@ if not isinstance(numeric_level, int):
 logging.basicConfig(level=numeric_level, format="%(asctime)s - %(levelname)s - %(message)s")
 
 CLIENTE_ID = int(os.getenv("CLIENTE_ID", "9999"))
+# Lista opcional de clientes atendidos por este agente numa única conexão (ex: "9001,9002")
+CLIENTE_IDS = [int(cid) for cid in os.getenv("CLIENTE_IDS", "").split(",") if cid.strip()] or [CLIENTE_ID]
+# Grupo opcional (ex: rede hoteleira) usado para filtrar o inventário de clientes conectados
+CLIENTE_GRUPO = os.getenv("CLIENTE_GRUPO")
 API_URL = os.getenv("API_URL", "http://127.0.0.1:18690")
 #URL da chamada para a API do DesbravadorConnect
 API_BASE_URL = f"{API_URL}/DSLPlugin/Executar?action="
@@ -39,6 +47,17 @@ AUTH_USER_WS = os.getenv("AUTH_USER", "user")
 AUTH_PASS_WS = os.getenv("AUTH_PASS", "user123")
 #URL da chamada para o WebSocket Server
 WEBSOCKET_URL = os.getenv("WEBSOCKET_URL", "ws://localhost:9000/ws")
+# Destino das respostas do DesbravadorConnect: "file" (grava em RESPONSE_DIR)
+# ou "websocket" (reenvia ao servidor em frames de RESPONSE_CHUNK_SIZE bytes)
+RESPONSE_SINK = os.getenv("RESPONSE_SINK", "file").lower()
+RESPONSE_DIR = os.getenv("RESPONSE_DIR", os.path.join(BASE_DIR, "respostas"))
+RESPONSE_CHUNK_SIZE = int(os.getenv("RESPONSE_CHUNK_SIZE", "65536"))
+# Retenção em RESPONSE_DIR: apaga respostas mais velhas que RESPONSE_MAX_AGE (s) e,
+# se o total passar de RESPONSE_MAX_TOTAL_BYTES, as mais antigas primeiro. 0 desativa cada limite
+RESPONSE_MAX_AGE = int(os.getenv("RESPONSE_MAX_AGE", str(7 * 86400)))
+RESPONSE_MAX_TOTAL_BYTES = int(os.getenv("RESPONSE_MAX_TOTAL_BYTES", str(1024 * 1024 * 1024)))
+RESPONSE_PRUNE_INTERVAL = int(os.getenv("RESPONSE_PRUNE_INTERVAL", "600"))
+LAST_PRUNE = 0
 TOKEN = None
 
 class SubscriberService(win32serviceutil.ServiceFramework):
@@ -97,18 +116,138 @@ async def authenticate():
                 log.write(f"[ERRO] Autenticação falhou: {e}\n")
             await asyncio.sleep(5)
 
-async def send_http_request(action_params):
+def prune_responses():
+    """
+    Aplica a retenção em RESPONSE_DIR: remove as respostas mais velhas que
+    RESPONSE_MAX_AGE e, enquanto o total passar de RESPONSE_MAX_TOTAL_BYTES,
+    as mais antigas. Roda no máximo a cada RESPONSE_PRUNE_INTERVAL segundos.
+    """
+    global LAST_PRUNE
+    now = time.time()
+    if now - LAST_PRUNE < RESPONSE_PRUNE_INTERVAL:
+        return
+    LAST_PRUNE = now
+    files = []
+    for entry in os.scandir(RESPONSE_DIR):
+        if entry.is_file():
+            st = entry.stat()
+            files.append((st.st_mtime, st.st_size, entry.path))
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    for mtime, size, path in files:
+        expired = RESPONSE_MAX_AGE and now - mtime > RESPONSE_MAX_AGE
+        over_budget = RESPONSE_MAX_TOTAL_BYTES and total > RESPONSE_MAX_TOTAL_BYTES
+        if not expired and not over_budget:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+class FileSink:
+    """Grava a resposta em disco, um chunk por vez."""
+    def __init__(self, cliente_id, request_id):
+        os.makedirs(RESPONSE_DIR, exist_ok=True)
+        try:
+            prune_responses()
+        except OSError as e:
+            with open(os.path.join(BASE_DIR, "SubscriberService.log"), "a", encoding="utf-8") as log:
+                log.write(f"[ERRO] Retenção de respostas falhou: {e}\n")
+        self.path = os.path.join(RESPONSE_DIR, f"{cliente_id}_{request_id}.resp")
+        self.file = open(self.path, "wb")
+
+    def write(self, chunk):
+        self.file.write(chunk)
+
+    def close(self, size, sha256):
+        self.file.close()
+
+    def abort(self, error):
+        self.file.close()
+        os.remove(self.path)
+
+class WebSocketSink:
+    """
+    Reenvia a resposta ao servidor em frames 'response_chunk'.
+    Cada frame é aguardado antes de ler o próximo chunk, então no máximo um chunk fica em memória.
+    """
+    def __init__(self, cliente_id, request_id, websocket, loop):
+        self.cliente_id = cliente_id
+        self.request_id = request_id
+        self.websocket = websocket
+        self.loop = loop
+        self.seq = 0
+
+    def _send(self, frame):
+        asyncio.run_coroutine_threadsafe(self.websocket.send(json.dumps(frame)), self.loop).result()
+
+    def write(self, chunk):
+        self._send({
+            "type": "response_chunk",
+            "cliente_id": self.cliente_id,
+            "request_id": self.request_id,
+            "seq": self.seq,
+            "data": base64.b64encode(chunk).decode("ascii")
+        })
+        self.seq += 1
+
+    def close(self, size, sha256):
+        self._send({
+            "type": "response_end",
+            "cliente_id": self.cliente_id,
+            "request_id": self.request_id,
+            "chunks": self.seq,
+            "size": size,
+            "sha256": sha256
+        })
+
+    def abort(self, error):
+        self._send({
+            "type": "response_end",
+            "cliente_id": self.cliente_id,
+            "request_id": self.request_id,
+            "chunks": self.seq,
+            "error": str(error)
+        })
+
+def stream_response(url, headers, sink):
+    """Lê a resposta em chunks de RESPONSE_CHUNK_SIZE e repassa ao sink. Retorna (status, tamanho, sha256)."""
+    size = 0
+    digest = hashlib.sha256()
+    try:
+        with requests.get(url, headers=headers, timeout=5, stream=True) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=RESPONSE_CHUNK_SIZE):
+                if not chunk:
+                    continue
+                size += len(chunk)
+                digest.update(chunk)
+                sink.write(chunk)
+            status_code = response.status_code
+    except Exception as e:
+        sink.abort(e)
+        raise
+    sha256 = digest.hexdigest()
+    sink.close(size, sha256)
+    return status_code, size, sha256
+
+async def send_http_request(action_params, cliente_id=CLIENTE_ID, websocket=None):
     global TOKEN
     TOKEN = await authenticate()
     url = API_BASE_URL + action_params
     headers = {"Authorization": f"Bearer {TOKEN}", "Content-Type": "application/json"}
+    request_id = uuid.uuid4().hex
     try:
         with open(os.path.join(BASE_DIR, "SubscriberService.log"), "a", encoding="utf-8") as log:
-            log.write(f"[HTTP] Enviando requisição para {url}\n")
-        response = await asyncio.to_thread(requests.get, url, headers=headers, timeout=5)
-        response.raise_for_status()
+            log.write(f"[HTTP] Enviando requisição {request_id} para {url}\n")
+        if RESPONSE_SINK == "websocket" and websocket is not None:
+            sink = WebSocketSink(cliente_id, request_id, websocket, asyncio.get_running_loop())
+        else:
+            sink = FileSink(cliente_id, request_id)
+        status_code, size, sha256 = await asyncio.to_thread(stream_response, url, headers, sink)
         with open(os.path.join(BASE_DIR, "SubscriberService.log"), "a", encoding="utf-8") as log:
-            log.write(f"[HTTP] Resposta recebida: {response.status_code} - {response.text}\n")
+            log.write(f"[HTTP] Resposta recebida: {status_code} - {size} bytes - sha256={sha256}\n")
     except requests.exceptions.RequestException as e:
         with open(os.path.join(BASE_DIR, "SubscriberService.log"), "a", encoding="utf-8") as log:
             log.write(f"[ERRO] Erro ao enviar requisição HTTP: {e}\n")
@@ -121,24 +260,62 @@ async def connect(stop_event):
                 log.write("[WEBSOCKET] Tentando conectar ao WebSocket...\n")
             websocket = await websockets.connect(WEBSOCKET_URL)
             with open(os.path.join(BASE_DIR, "SubscriberService.log"), "a", encoding="utf-8") as log:
-                log.write(f"[WEBSOCKET] Conectado! Enviando ID {CLIENTE_ID} com autenticação\n")
-            # Envia o ID do cliente junto com as credenciais para autenticação no WebSocket
-            await websocket.send(json.dumps({
-                "cliente_id": CLIENTE_ID,
+                log.write(f"[WEBSOCKET] Conectado! Enviando IDs {CLIENTE_IDS} com autenticação\n")
+            # Envia os IDs dos clientes junto com as credenciais para autenticação no WebSocket
+            handshake = {
+                "cliente_ids": CLIENTE_IDS,
                 "username": AUTH_USER_WS,
                 "password": AUTH_PASS_WS
-            }))
+            }
+            if CLIENTE_GRUPO:
+                handshake["group"] = CLIENTE_GRUPO
+            await websocket.send(json.dumps(handshake))
             while not stop_event.is_set():
                 try:
                     message = await asyncio.wait_for(websocket.recv(), timeout=1)
                     with open(os.path.join(BASE_DIR, "SubscriberService.log"), "a", encoding="utf-8") as log:
                         log.write(f"[WEBSOCKET] Mensagem recebida: {message}\n")
-                    data = json.loads(message)
+                    try:
+                        data = json.loads(message)
+                    except ValueError:
+                        # Textos do servidor ("ping", "OK: ...") não são ações
+                        continue
+                    if not isinstance(data, dict):
+                        continue
+                    if data.get("type") == "reconnect":
+                        # Servidor desligando: reconecta (em outro worker) após o atraso indicado
+                        delay = float(data.get("delay", 5))
+                        with open(os.path.join(BASE_DIR, "SubscriberService.log"), "a", encoding="utf-8") as log:
+                            log.write(f"[WEBSOCKET] Servidor pediu reconexão em {delay}s\n")
+                        await websocket.close()
+                        await asyncio.sleep(delay)
+                        break
                     action_params = data.get("action_params")
+                    deadline = data.get("deadline")
+                    if action_params and deadline is not None and time.time() * 1000 >= deadline:
+                        # Ação vencida: não executa e avisa o servidor (métricas/trace)
+                        with open(os.path.join(BASE_DIR, "SubscriberService.log"), "a", encoding="utf-8") as log:
+                            log.write(f"[PROCESSO] Ação vencida descartada: {action_params}\n")
+                        await websocket.send(json.dumps({
+                            "type": "action_expired",
+                            "cliente_id": data.get("cliente_id", CLIENTE_ID),
+                            "coalesce_key": data.get("coalesce_key"),
+                            "trace_id": data.get("trace_id")
+                        }))
+                        continue
                     if action_params:
                         with open(os.path.join(BASE_DIR, "SubscriberService.log"), "a", encoding="utf-8") as log:
                             log.write(f"[PROCESSO] Enviando requisição com params: {action_params}\n")
-                        await send_http_request(action_params)
+                        started = time.monotonic()
+                        await send_http_request(action_params, data.get("cliente_id", CLIENTE_ID), websocket)
+                        # Confirma a execução para o servidor liberar a deduplicação da ação e fechar o trace
+                        await websocket.send(json.dumps({
+                            "type": "action_done",
+                            "cliente_id": data.get("cliente_id", CLIENTE_ID),
+                            "coalesce_key": data.get("coalesce_key"),
+                            "trace_id": data.get("trace_id"),
+                            "exec_ms": int((time.monotonic() - started) * 1000)
+                        }))
                 except asyncio.TimeoutError:
                     continue
                 except websockets.exceptions.ConnectionClosed:
@@ -0,0 +1,330 @@
+"""
+Teste de resistência (soak) do serverWS contra um Redis local.
+
+Sobe o serverWS no próprio processo e simula agentes conectando e
+desconectando sem parar (com mensagens para clientes online e offline,
+action_done e quedas abruptas). Periodicamente grava um snapshot com memória
+(tracemalloc), contagem de objetos, estruturas do ConnectionManager, tasks
+do asyncio e chaves do Redis (active_clients, pending_*, ...).
+
+Falha (código de saída 1) se, depois do aquecimento, a memória, os objetos
+ou as chaves crescerem por conexão acima dos limites, ou se sobrar estado
+após todos os agentes desconectarem.
+
+Uso:
+    REDIS_URL=redis://localhost:6379/15 python soakServerWS.py --duration 3600 --agents 50
+Use um banco do Redis só para o teste: as chaves dos clientes simulados ficam nele.
+
+Contra o Redis Cluster local (perfil 'cluster' do docker-compose.yml), o que
+exercita SSUBSCRIBE/SPUBLISH, o SCAN paginado por nó e os pipelines entre slots:
+    docker compose --profile cluster up -d
+    docker exec server_ws sh /home/scripts/soak_cluster.sh --duration 600
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from collections import Counter
+
+# Antes de importar o serverWS: Redis local, logs quietos e sem rastreamento
+# (os traces enchem até TRACE_MAX_PER_CLIENT por cliente e distorceriam a medição)
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/15")
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+os.environ.setdefault("TRACING_ENABLED", "0")
+os.environ.setdefault("WORKER_ID", "soak")
+
+import uvicorn
+import websockets
+
+import serverWS
+from redis_topology import publish_event, scan_page
+
+SOAK_GROUP = "soak"
+# Chaves acompanhadas: crescimento por conexão acima do limite indica vazamento
+KEY_PATTERNS = {
+    "pending_messages": "pending_messages:*",
+    "pending_coalesce": "pending_coalesce:*",
+    "pending_stats": "pending_stats:*",
+    "pending_lock": "pending_lock:*",
+    "inflight": "inflight:*",
+    "rate_limit": "rate_limit:*",
+}
+
+def parse_args():
+    env = os.getenv
+    parser = argparse.ArgumentParser(description="Teste de resistência do serverWS (churn de conexões)")
+    parser.add_argument("--duration", type=float, default=float(env("SOAK_DURATION", "3600")), help="duração (s)")
+    parser.add_argument("--agents", type=int, default=int(env("SOAK_AGENTS", "50")), help="agentes simultâneos")
+    parser.add_argument("--clients", type=int, default=int(env("SOAK_CLIENTS", "200")), help="cliente_ids distintos (reutilizados)")
+    parser.add_argument("--first-client", type=int, default=int(env("SOAK_FIRST_CLIENT", "900000")), help="primeiro cliente_id simulado")
+    parser.add_argument("--max-ids", type=int, default=int(env("SOAK_MAX_IDS", "3")), help="máximo de cliente_ids por conexão")
+    parser.add_argument("--hold", type=float, default=float(env("SOAK_HOLD", "2")), help="tempo médio conectado (s)")
+    parser.add_argument("--messages", type=int, default=int(env("SOAK_MESSAGES", "5")), help="mensagens por conexão")
+    parser.add_argument("--offline-ratio", type=float, default=float(env("SOAK_OFFLINE_RATIO", "0.3")), help="fração das mensagens para clientes offline")
+    parser.add_argument("--abort-ratio", type=float, default=float(env("SOAK_ABORT_RATIO", "0.2")), help="fração das conexões derrubadas sem close")
+    parser.add_argument("--interval", type=float, default=float(env("SOAK_INTERVAL", "60")), help="intervalo entre snapshots (s)")
+    # Aquecimento maior que os TTLs curtos (inflight, pending_lock) para que essas chaves já estejam estáveis
+    parser.add_argument("--warmup", type=float, default=float(env("SOAK_WARMUP", str(max(120, 2 * serverWS.INFLIGHT_DEDUP_TTL)))),
+                        help="tempo (s) antes do snapshot de referência")
+    parser.add_argument("--max-bytes-per-conn", type=float, default=float(env("SOAK_MAX_BYTES_PER_CONN", "1024")))
+    parser.add_argument("--max-objects-per-conn", type=float, default=float(env("SOAK_MAX_OBJECTS_PER_CONN", "5")))
+    parser.add_argument("--max-keys-per-conn", type=float, default=float(env("SOAK_MAX_KEYS_PER_CONN", "0.05")))
+    parser.add_argument("--max-task-growth", type=int, default=int(env("SOAK_MAX_TASK_GROWTH", "5")))
+    parser.add_argument("--frames", type=int, default=int(env("SOAK_TRACEMALLOC_FRAMES", "1")), help="frames guardados pelo tracemalloc")
+    parser.add_argument("--port", type=int, default=int(env("SOAK_PORT", "9100")))
+    parser.add_argument("--report", default=env("SOAK_REPORT"), help="arquivo JSON lines com os snapshots")
+    return parser.parse_args()
+
+# -----------------------------------------------------------------------------
+# Agentes simulados
+# -----------------------------------------------------------------------------
+class Churn:
+    def __init__(self, args):
+        self.args = args
+        self.url = f"ws://127.0.0.1:{args.port}/ws"
+        self.pool = list(range(args.first_client, args.first_client + args.clients))
+        self.online = Counter()
+        self.stats = Counter()
+        self.username, self.password = next(iter(serverWS.VALID_USERS.items()))
+
+    async def publish(self, cliente_id: int, n: int):
+        message = {
+            "cliente_id": cliente_id,
+            "action_params": f"Soak&n={n}",
+            "priority": random.choice(serverWS.PRIORITY_LANES),
+        }
+        if n % 3 == 0:
+            message["coalesce_key"] = f"Soak:{n % 7}"
+        await publish_event(serverWS.redis_client, cliente_id, json.dumps(message))
+        self.stats["published"] += 1
+
+    async def agent_once(self, n: int):
+        cliente_ids = random.sample(self.pool, random.randint(1, self.args.max_ids))
+        websocket = await websockets.connect(self.url, open_timeout=10, ping_interval=None)
+        self.online.update(cliente_ids)
+        try:
+            await websocket.send(json.dumps({
+                "cliente_ids": cliente_ids, "username": self.username,
+                "password": self.password, "group": SOAK_GROUP
+            }))
+            reply = await asyncio.wait_for(websocket.recv(), timeout=10)
+            if not reply.startswith("OK"):
+                self.stats["handshake_errors"] += 1
+                return
+
+            for i in range(self.args.messages):
+                offline = [cid for cid in self.pool if not self.online[cid]]
+                if offline and random.random() < self.args.offline_ratio:
+                    await self.publish(random.choice(offline), n * 1000 + i)
+                else:
+                    await self.publish(random.choice(cliente_ids), n * 1000 + i)
+
+            end = time.monotonic() + random.uniform(0, 2 * self.args.hold)
+            while (remaining := end - time.monotonic()) > 0:
+                try:
+                    raw = await asyncio.wait_for(websocket.recv(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                try:
+                    message = json.loads(raw)
+                except ValueError:
+                    continue
+                if not isinstance(message, dict) or "action_params" not in message:
+                    continue
+                self.stats["received"] += 1
+                if message.get("coalesce_key"):
+                    await websocket.send(json.dumps({
+                        "type": "action_done", "cliente_id": message["cliente_id"],
+                        "coalesce_key": message["coalesce_key"]
+                    }))
+        finally:
+            self.online.subtract(cliente_ids)
+            if random.random() < self.args.abort_ratio:
+                # Queda sem handshake de fechamento (rede caiu, processo morto)
+                websocket.transport.abort()
+                self.stats["aborted"] += 1
+            else:
+                await websocket.close()
+            self.stats["connections"] += 1
+
+    async def agent_loop(self, deadline: float, n: int):
+        while time.monotonic() < deadline:
+            try:
+                await self.agent_once(n)
+            except Exception as e:
+                self.stats["agent_errors"] += 1
+                self.stats[f"error:{type(e).__name__}"] += 1
+                await asyncio.sleep(1)
+            n += self.args.agents
+
+# -----------------------------------------------------------------------------
+# Snapshots
+# -----------------------------------------------------------------------------
+async def count_keys(pattern: str) -> int:
+    total, cursor = 0, "0"
+    while True:
+        cursor, keys = await scan_page(serverWS.redis_client, cursor, pattern, 1000)
+        total += len(keys)
+        if cursor == "0":
+            return total
+
+async def pending_bytes() -> int:
+    """Soma de /pending_memory (só informativo; em cluster usa pipelines entre slots)."""
+    total, cursor = 0, "0"
+    while True:
+        page = await serverWS.get_pending_memory(cursor=cursor, count=1000)
+        total += page["bytes"]
+        cursor = page["cursor"]
+        if cursor == "0":
+            return total
+
+async def take_snapshot(churn: Churn) -> dict:
+    gc.collect()
+    manager = serverWS.connection_manager
+    snapshot = {
+        "elapsed": round(time.monotonic() - churn.started, 1),
+        "connections": churn.stats["connections"],
+        "traced_bytes": tracemalloc.get_traced_memory()[0],
+        "objects": len(gc.get_objects()),
+        "tasks": len(asyncio.all_tasks()),
+        "manager": {
+            "active_connections": len(manager.active_connections),
+            "connection_clients": len(manager.connection_clients),
+            "outbound": len(manager.outbound),
+            "drain_tasks": len(manager.drain_tasks),
+            "drain_requested": len(manager.drain_requested),
+            "client_groups": len(manager.client_groups),
+        },
+        "redis": {
+            "active_clients": await serverWS.presence_total(),
+            "group_clients": await serverWS.redis_client.scard(serverWS.group_key(SOAK_GROUP)),
+            **{name: await count_keys(pattern) for name, pattern in KEY_PATTERNS.items()},
+        },
+        "pending_bytes": await pending_bytes(),
+        "stats": dict(churn.stats),
+    }
+    return snapshot
+
+def drift(snapshot: dict, baseline: dict, args) -> list:
+    """Crescimento por conexão desde a referência; retorna as violações."""
+    connections = snapshot["connections"] - baseline["connections"]
+    if connections <= 0:
+        return []
+    failures = []
+    per_conn = (snapshot["traced_bytes"] - baseline["traced_bytes"]) / connections
+    snapshot["bytes_per_conn"] = round(per_conn, 1)
+    if per_conn > args.max_bytes_per_conn:
+        failures.append(f"memória cresceu {per_conn:.0f} bytes/conexão (limite {args.max_bytes_per_conn})")
+    per_conn = (snapshot["objects"] - baseline["objects"]) / connections
+    snapshot["objects_per_conn"] = round(per_conn, 2)
+    if per_conn > args.max_objects_per_conn:
+        failures.append(f"objetos cresceram {per_conn:.2f}/conexão (limite {args.max_objects_per_conn})")
+    for name, count in snapshot["redis"].items():
+        per_conn = (count - baseline["redis"][name]) / connections
+        if per_conn > args.max_keys_per_conn:
+            failures.append(f"Redis '{name}' cresceu {per_conn:.3f}/conexão (limite {args.max_keys_per_conn})")
+    return failures
+
+def leftovers(snapshot: dict, baseline: dict, args) -> list:
+    """Estado que deveria ter sumido com todos os agentes desconectados."""
+    failures = [f"{name}={count} após desconectar todos" for name, count in snapshot["manager"].items() if count]
+    for name in ("active_clients", "group_clients"):
+        if snapshot["redis"][name]:
+            failures.append(f"Redis '{name}'={snapshot['redis'][name]} após desconectar todos")
+    if snapshot["tasks"] > baseline["tasks"] + args.max_task_growth:
+        failures.append(f"tasks do asyncio: {snapshot['tasks']} (referência {baseline['tasks']})")
+    return failures
+
+def print_growth(baseline_trace, baseline_types: Counter):
+    print("\nMaior crescimento de memória desde a referência (tracemalloc):")
+    stats = [stat for stat in tracemalloc.take_snapshot().compare_to(baseline_trace, "lineno") if stat.size_diff > 0]
+    for stat in stats[:15]:
+        print(f"  {stat}")
+    print("\nMaior crescimento de objetos por tipo:")
+    types = Counter(type(obj).__name__ for obj in gc.get_objects())
+    types.subtract(baseline_types)
+    for name, growth in types.most_common(15):
+        if growth > 0:
+            print(f"  {name}: +{growth}")
+
+def emit(snapshot: dict, report):
+    line = json.dumps(snapshot)
+    print(line, flush=True)
+    if report:
+        report.write(line + "\n")
+        report.flush()
+
+# -----------------------------------------------------------------------------
+# Execução
+# -----------------------------------------------------------------------------
+async def run(args) -> int:
+    config = uvicorn.Config(serverWS.app, host="127.0.0.1", port=args.port, log_level="error", lifespan="on")
+    server = uvicorn.Server(config)
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        if server_task.done():
+            server_task.result()
+            return 1
+        await asyncio.sleep(0.1)
+
+    churn = Churn(args)
+    churn.started = time.monotonic()
+    deadline = churn.started + args.duration
+    agents = [asyncio.create_task(churn.agent_loop(deadline, n)) for n in range(args.agents)]
+
+    report = open(args.report, "a") if args.report else None
+    baseline = baseline_trace = baseline_types = None
+    failures = []
+    try:
+        while time.monotonic() < deadline and not failures:
+            await asyncio.sleep(min(args.interval, max(0.0, deadline - time.monotonic())))
+            snapshot = await take_snapshot(churn)
+            if baseline is None and snapshot["elapsed"] >= args.warmup:
+                baseline = snapshot
+                baseline_trace = tracemalloc.take_snapshot()
+                baseline_types = Counter(type(obj).__name__ for obj in gc.get_objects())
+                snapshot["baseline"] = True
+            elif baseline is not None:
+                failures = drift(snapshot, baseline, args)
+            emit(snapshot, report)
+
+        # Fim do churn: espera os agentes saírem e o servidor limpar as conexões
+        await asyncio.gather(*agents, return_exceptions=True)
+        await serverWS.connection_manager.cleanup_inactive_connections()
+        await asyncio.sleep(1)
+        final = await take_snapshot(churn)
+        final["final"] = True
+        if baseline is None:
+            print(f"\nAquecimento ({args.warmup:.0f}s) não concluído; só o estado final foi verificado.")
+            baseline = final
+        else:
+            failures = failures or drift(final, baseline, args)
+        failures += leftovers(final, baseline, args)
+        emit(final, report)
+        if failures and baseline_trace is not None:
+            print_growth(baseline_trace, baseline_types)
+    finally:
+        for task in agents:
+            task.cancel()
+        if report:
+            report.close()
+        server.should_exit = True
+        await server_task
+
+    if failures:
+        print("\nFALHOU:")
+        for failure in failures:
+            print(f"  - {failure}")
+        return 1
+    print(f"\nOK: {churn.stats['connections']} conexões sem deriva acima dos limites.")
+    return 0
+
+if __name__ == "__main__":
+    args = parse_args()
+    tracemalloc.start(args.frames)
+    sys.exit(asyncio.run(run(args)))
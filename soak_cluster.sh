@@ -0,0 +1,9 @@
+#!/bin/bash
+# Teste de resistência do serverWS contra o Redis Cluster local do docker-compose.yml
+# (docker compose --profile cluster up -d). Argumentos extras vão para o soakServerWS.py.
+cd /usr/src/app
+export REDIS_CLUSTER=1
+export REDIS_URL="${REDIS_URL:-redis://redis-node-1:7001}"
+export PRESENCE_SHARDS="${PRESENCE_SHARDS:-16}"
+export EVENT_CHANNEL_SHARDS="${EVENT_CHANNEL_SHARDS:-16}"
+python soakServerWS.py "$@"
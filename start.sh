@@ -1,7 +1,8 @@
 #!/bin/bash
 
 echo "Iniciando server.py com 4 workers..."
-uvicorn serverWS:app --workers 4 --host 0.0.0.0 --port 9000 --log-level error --reload &
+# Sem --reload: o SIGTERM chega aos workers, que drenam as conexões antes de sair
+uvicorn serverWS:app --workers 4 --host 0.0.0.0 --port 9000 --log-level error --timeout-graceful-shutdown 30 &
 
 echo "Iniciando scheduler_api.py com 2 workers..."
 uvicorn scheduler_api:app --host 0.0.0.0 --port 9001 --workers 2 --log-level error --reload &  
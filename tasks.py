@@ -1,25 +1,58 @@
-import redis
 import json
+from datetime import timezone
 
-# Defina o canal corretamente
-CHANNEL = "canal_eventos"
+from rq import get_current_job
 
-def publish_event(cliente_id: int, action_params: str):
+from deadlines import compute_deadline, count_expired, is_expired
+from redis_topology import event_channel, get_redis, publish_event as publish_to_channel
+from tracing import new_trace_id, now_ms, record_hop
+
+def publish_event(cliente_id: int, action_params: str, coalesce_key: str = None, priority: str = "bulk",
+                  trace_id: str = None, ttl_seconds: float = None, deadline=None):
     """
     Publica uma mensagem no canal 'canal_eventos'.
+    'coalesce_key' (opcional) faz uma pendente mais nova substituir a anterior com a mesma chave.
+    'priority' define a fila: agendamentos são "bulk" por padrão; "interactive" é servida antes.
+    'trace_id' vem do POST /schedule; sem ele um novo trace é iniciado.
+    'deadline' (epoch ms ou data ISO) e/ou 'ttl_seconds' (a partir de agora) definem até quando
+    a ação ainda é útil; vencida, é descartada em vez de publicada.
     """
     try:
-        # Criar conexão com Redis
-        redis_client = redis.Redis.from_url("redis://redis:6379", decode_responses=True)
-        
+        worker_start = now_ms()
+        # Criar conexão com Redis (REDIS_URL / REDIS_CLUSTER, ver redis_topology.py)
+        redis_client = get_redis(decode_responses=True)
+
+        trace_id = trace_id or new_trace_id()
+        job = get_current_job()
+        if job is not None and job.enqueued_at is not None:
+            # enqueued_at = momento em que o rq-scheduler moveu o job para a fila (UTC; naive em versões antigas do RQ)
+            enqueued_at = job.enqueued_at
+            if enqueued_at.tzinfo is None:
+                enqueued_at = enqueued_at.replace(tzinfo=timezone.utc)
+            record_hop(redis_client, cliente_id, trace_id, "scheduler_fire", int(enqueued_at.timestamp() * 1000))
+        record_hop(redis_client, cliente_id, trace_id, "worker_start", worker_start)
+
         # Criar mensagem
-        message = {"cliente_id": cliente_id, "action_params": action_params}
+        message = {"cliente_id": cliente_id, "action_params": action_params, "priority": priority}
+        if coalesce_key:
+            message["coalesce_key"] = coalesce_key
+        if trace_id:
+            message["trace_id"] = trace_id
+        if deadline is not None or ttl_seconds is not None:
+            message["deadline"] = compute_deadline(ttl_seconds, deadline, start_ms=worker_start)
+
+        if is_expired(message, worker_start):
+            count_expired(redis_client, "publish")
+            record_hop(redis_client, cliente_id, trace_id, "expired", expired_stage="publish")
+            print(f"[DEBUG] Mensagem vencida antes da publicação, descartada: {message}")
+            return
 
         # Publicar no canal
-        result = redis_client.publish(CHANNEL, json.dumps(message))
+        result = publish_to_channel(redis_client, cliente_id, json.dumps(message))
+        record_hop(redis_client, cliente_id, trace_id, "published")
         
         # Debug para confirmar que foi publicado
-        print(f"[DEBUG] Mensagem publicada no canal {CHANNEL}: {message}, Retorno do Redis: {result}")
+        print(f"[DEBUG] Mensagem publicada no canal {event_channel(cliente_id)}: {message}, Retorno do Redis: {result}")
 
     except Exception as e:
-        print(f"[ERROR] Falha ao publicar no canal {CHANNEL}: {e}")
+        print(f"[ERROR] Falha ao publicar no canal {event_channel(cliente_id)}: {e}")
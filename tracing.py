@@ -0,0 +1,127 @@
+import os
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from redis_topology import client_tag
+
+# -----------------------------------------------------------------------------
+# Rastreamento por mensagem: cada etapa grava um carimbo (epoch em ms) em
+# 'trace:{trace_id}'; 'traces:{cliente_id}' guarda os últimos traces do cliente.
+# Ao sair da lista (TRACE_MAX_PER_CLIENT), o hash do trace é apagado: o total
+# fica limitado a clientes x TRACE_MAX_PER_CLIENT, e não ao tráfego do período.
+# TRACE_TTL só recolhe os traces de clientes que pararam de receber mensagens.
+# -----------------------------------------------------------------------------
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "1").lower() in ("1", "true", "yes")
+TRACE_TTL = int(os.getenv("TRACE_TTL", "86400"))
+TRACE_MAX_PER_CLIENT = int(os.getenv("TRACE_MAX_PER_CLIENT", "200"))
+
+# Etapas na ordem do percurso da mensagem:
+#   accepted       - recebida em POST /schedule ou POST /message
+#   due            - horário agendado (schedule_time)
+#   scheduler_fire - rq-scheduler moveu o job para a fila do RQ
+#   worker_start   - worker do RQ começou a executar tasks.publish_event
+#   published      - publicada no canal de eventos
+#   listener       - recebida pelo redis_listener do worker que atende o cliente
+#   pending_stored - guardada nas pendentes (cliente offline ou fila cheia)
+#   sent           - enviada pelo socket
+#   completed      - subscriber confirmou a execução ('action_done')
+HOPS = (
+    "accepted", "due", "scheduler_fire", "worker_start", "published",
+    "listener", "pending_stored", "sent", "completed"
+)
+
+def new_trace_id() -> Optional[str]:
+    return uuid.uuid4().hex if TRACING_ENABLED else None
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+def trace_key(trace_id: str) -> str:
+    return f"trace:{trace_id}"
+
+def client_traces_key(cliente_id: int) -> str:
+    return f"traces:{client_tag(cliente_id)}"
+
+def record_hop(conn, cliente_id: int, trace_id: Optional[str], hop: str, ts_ms: Optional[int] = None, **extra):
+    """Grava o carimbo da etapa (conexão síncrona). Sem trace_id não faz nada."""
+    if not trace_id:
+        return
+    key = trace_key(trace_id)
+    pipe = conn.pipeline(transaction=False)
+    pipe.hsetnx(key, "cliente_id", cliente_id)
+    pipe.hset(key, mapping={hop: ts_ms or now_ms(), **extra})
+    pipe.expire(key, TRACE_TTL)
+    is_new = pipe.execute()[0]
+    if is_new:
+        evicted = _index_trace(conn.pipeline(transaction=False), cliente_id, trace_id).execute()[1]
+        if evicted:
+            _delete_traces(conn.pipeline(transaction=False), evicted).execute()
+
+async def record_hop_async(conn, cliente_id: int, trace_id: Optional[str], hop: str, ts_ms: Optional[int] = None, **extra):
+    """Mesmo que record_hop, para conexões redis.asyncio."""
+    if not trace_id:
+        return
+    key = trace_key(trace_id)
+    async with conn.pipeline(transaction=False) as pipe:
+        pipe.hsetnx(key, "cliente_id", cliente_id)
+        pipe.hset(key, mapping={hop: ts_ms or now_ms(), **extra})
+        pipe.expire(key, TRACE_TTL)
+        is_new = (await pipe.execute())[0]
+    if is_new:
+        async with conn.pipeline(transaction=False) as pipe:
+            evicted = (await _index_trace(pipe, cliente_id, trace_id).execute())[1]
+        if evicted:
+            async with conn.pipeline(transaction=False) as pipe:
+                await _delete_traces(pipe, evicted).execute()
+
+def _index_trace(pipe, cliente_id: int, trace_id: str):
+    """
+    Inclui o trace na lista do cliente, limitada a TRACE_MAX_PER_CLIENT.
+    O segundo resultado do pipeline são os trace_ids que saíram da lista.
+    """
+    key = client_traces_key(cliente_id)
+    pipe.lpush(key, trace_id)
+    pipe.lrange(key, TRACE_MAX_PER_CLIENT, -1)
+    pipe.ltrim(key, 0, TRACE_MAX_PER_CLIENT - 1)
+    pipe.expire(key, TRACE_TTL)
+    return pipe
+
+def _delete_traces(pipe, trace_ids):
+    """Apaga os hashes dos traces (um DEL por chave: no cluster cada uma está num slot)."""
+    for trace_id in trace_ids:
+        pipe.delete(trace_key(trace_id.decode() if isinstance(trace_id, bytes) else trace_id))
+    return pipe
+
+def hop_breakdown(trace: Dict[str, str]) -> List[dict]:
+    """Tempo (ms) entre etapas consecutivas presentes no trace."""
+    stamps = [(hop, int(trace[hop])) for hop in HOPS if hop in trace]
+    return [
+        {"segment": f"{prev}->{hop}", "ms": ts - prev_ts}
+        for (prev, prev_ts), (hop, ts) in zip(stamps, stamps[1:])
+    ]
+
+def slowest_hop_stats(breakdowns: List[List[dict]]) -> dict:
+    """
+    Estatísticas por trecho (quantidade, média, p95, máximo) e quantas vezes
+    cada trecho foi o mais lento do trace.
+    """
+    per_segment: Dict[str, List[int]] = {}
+    slowest: Dict[str, int] = {}
+    for breakdown in breakdowns:
+        for item in breakdown:
+            per_segment.setdefault(item["segment"], []).append(item["ms"])
+        if breakdown:
+            worst = max(breakdown, key=lambda item: item["ms"])["segment"]
+            slowest[worst] = slowest.get(worst, 0) + 1
+
+    segments = {}
+    for segment, values in per_segment.items():
+        values.sort()
+        segments[segment] = {
+            "count": len(values),
+            "avg_ms": round(sum(values) / len(values), 1),
+            "p95_ms": values[min(len(values) - 1, int(len(values) * 0.95))],
+            "max_ms": values[-1]
+        }
+    return {"segments": segments, "slowest_counts": slowest}